@@ -1,27 +1,44 @@
+import os
+import glob
+import json
+import hashlib
+
 import numpy as np
 import pandas as pd
-from pandas.api.types import CategoricalDtype
+import pyarrow as pa
+import pyarrow.parquet as pq
 from matplotlib.lines import Line2D
 import matplotlib.ticker as mtick
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import StandardScaler
 pd.options.mode.chained_assignment = None 
 
 from config import (
     speed_labels, 
     income_labels, 
     redlininggrade2name, 
-    race_labels
+    race_labels,
+    FILTER_DIR
 )
+from manifest import fingerprint
+from storage import read_speed_price
 
 RACE_COL = 'race_perc_non_white'
 
+# columns `filter_df` and `bucket_and_bin` need, whatever else is asked for.
+FILTER_COLS = [
+    'major_city', 'state', 'speed_down', 'price', 'contract_provider',
+    'income_lmi', 'median_household_income', 'race_perc_non_white'
+]
+NYC_CITIES = ['new york', 'brooklyn', 'queens', 'staten island', 'brooklyn', 'bronx']
+HOMOGENOUS_CITIES = ['bridgeport', 'wilmington']
+
+# filtered frames loaded in this session, by the arguments to `filter_df`.
+_filtered = {}
+
 def aspirational_quartile(series, labels):
-    desc = series.describe()
+    # min, quartiles and max, like `series.describe()` without the rest of it.
     bins = []
-    sections = ['min', '25%','50%', '75%', 'max']
-    for sect in sections:
-        boundry = desc[sect]
+    for boundry in series.quantile([0, .25, .5, .75, 1]).values:
         if len(bins) != 0:
             if bins[-1] == boundry:
                 bins[-1] = bins[-1] - .001
@@ -35,64 +52,125 @@ def aspirational_quartile(series, labels):
 
 
 ## For all ISP analysis
-def filter_df(fn, isp):
+def source_fingerprint(fn):
+    """
+    The size and mtime of `fn`, or of every file in it for a Parquet dataset.
     """
-    Filters out no service offers, and cities which we can't analyze
+    fn = os.path.abspath(fn)
+    if os.path.isdir(fn):
+        fns = sorted(glob.glob(os.path.join(fn, '**', '*.parquet'), recursive=True))
+    else:
+        fns = [fn]
+    return {f: fingerprint(f, with_hash=False) for f in fns}
+
+def read_filtered(fn, source):
     """
-    df = pd.read_csv(fn)
+    The frame cached at `fn`, if it was filtered from the same `source`.
+    """
+    if not os.path.exists(fn):
+        return None
+    metadata = pq.read_schema(fn).metadata or {}
+    if json.loads(metadata.get(b'filter_df', b'null')) != source:
+        return None
+    return pq.read_table(fn).to_pandas()
+
+def write_filtered(df, fn, source):
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # mixed-type columns can't be stored, so this frame is only cached in memory.
+        return
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'filter_df'] = json.dumps(source).encode()
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    pq.write_table(table.replace_schema_metadata(metadata), fn + '.tmp')
+    os.replace(fn + '.tmp', fn)
+
+def filter_df(fn, isp, columns=None, cities=None, limitations=False, cache=True):
+    """
+    Filters out no service offers, and cities which we can't analyze.
+    `fn` is a speed_price CSV or the Parquet dataset from `storage.write_offers`.
+    Only `columns` and `cities` are read if given, but note that income and 
+    race quartiles are then relative to those cities.
+    The result is cached in memory and in `FILTER_DIR`, until `fn` changes, 
+    so calling this again with the same arguments doesn't re-read `fn`.
+    """
+    if not cache:
+        return _filter_df(fn, isp, columns, cities, limitations)
+    args = [os.path.abspath(fn), isp, 
+            sorted(columns) if columns is not None else None,
+            sorted(cities) if cities is not None else None, 
+            limitations]
+    key = hashlib.sha1(json.dumps(args).encode()).hexdigest()
+    source = source_fingerprint(fn)
+    if key in _filtered and _filtered[key][0] == source:
+        return _filtered[key][1].copy()
+    fn_cache = os.path.join(FILTER_DIR, f"{isp.lower().replace('&', '')}-{key[:16]}.parquet")
+    df = read_filtered(fn_cache, source)
+    if df is None:
+        df = _filter_df(fn, isp, columns, cities, limitations)
+        write_filtered(df, fn_cache, source)
+    _filtered[key] = (source, df)
+    return df.copy()
+
+def _filter_df(fn, isp, columns=None, cities=None, limitations=False):
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + FILTER_COLS))
+    if cities is not None and isp == 'Verizon' and 'new york city' in cities:
+        cities = list(cities) + NYC_CITIES
+    df = read_speed_price(fn, isp=isp, columns=columns, cities=cities)
     df = df[df.speed_down != 0]
-    df = bucket_and_bin(df)
+    df = bucket_and_bin(df, limitations=limitations)
     df['isp'] = isp
     if isp == 'Verizon':
         df.price = df.price.replace({40: 39.99, 49.99: 39.99})
         df = df[df.price == 39.99]
-        nyc_cities = ['new york', 'brooklyn', 'queens', 'staten island', 'brooklyn', 'bronx']
-        nyc = []
-        for city, _df in df.groupby('major_city'):
-            if city in nyc_cities:
-                nyc.extend(_df.to_dict(orient='records'))
-        nyc = pd.DataFrame(nyc)
-        nyc['major_city'] = 'new york city'
-        
-        # add NYC
-        df = df[~df.major_city.isin(nyc_cities)]
-        df = df.append(nyc)
+        # the boroughs are one city.
+        df.loc[df.major_city.isin(NYC_CITIES), 'major_city'] = 'new york city'
         
     elif isp == 'EarthLink':
         df = df[df.contract_provider.isin(['AT&T', 'CenturyLink'])]
         
-    homogenous_cities = {'bridgeport', 'wilmington'}
-    df = df[~df.major_city.isin(homogenous_cities)]
+    df = df[~df.major_city.isin(HOMOGENOUS_CITIES)]
     return df
 
 
+def speed_bins(speed_down):
+    return pd.cut(
+        speed_down, 
+        [-1, 0.00001, 25,  100, 200, 100000],
+        labels=speed_labels,
+        right=False
+    )
+
+def binned_rows(df):
+    """
+    A fingerprint of the rows and columns `bucket_and_bin` bins on,
+    to tell whether `df` was already binned as it is now.
+    """
+    cols = ['speed_down', 'income_lmi', 'median_household_income', 'race_perc_non_white']
+    hashes = pd.util.hash_pandas_object(df[[c for c in cols if c in df]], index=True)
+    return len(df), int(hashes.sum())
+
 def bucket_and_bin(df, limitations=False):
-    """This is how we wrangle our data"""
+    """
+    This is how we wrangle our data.
+    The scheme used is recorded in `df.attrs['bucket_and_bin']`,
+    so binning the same rows again the same way does nothing.
+    Quartiles are relative to the rows in `df`, so a subset (like one city) is re-binned.
+    """
     # These are our IVs
     # https://www.federalreserve.gov/consumerscommunities/cra_resources.htm
     df.loc[df['income_lmi'] < -100, 'income_lmi'] = None   
     df.loc[df['median_household_income'] == -666666666.0, 'median_household_income'] = None  
     
-    df['income_level'] = aspirational_quartile(
-        df['median_household_income'],
-        labels=['Low', 'Middle-Lower', 'Middle-Upper', 'Upper Income'],
-    ) 
+    scheme = 'limitations' if limitations else 'default'
+    rows = binned_rows(df)
+    binned = df.attrs.get('bucket_and_bin', {})
+    if binned.get('scheme') == scheme and binned.get('rows') == rows:
+        return df
     
-    df['speed_down_bins'] = pd.cut(
-        df.speed_down, 
-        [-1, 0.00001, 25,  100, 200, 100000],
-        labels=speed_labels,
-        right=False
-    )
- 
-    try:
-        df['race_quantile'] = aspirational_quartile(
-            df.race_perc_non_white, 
-            labels=race_labels
-        )
-        
-    except:
-        print(df.major_city.iloc[0])
+    df['speed_down_bins'] = speed_bins(df.speed_down)
     
     if limitations:
         df['race_quantile'] = pd.cut(df['race_perc_non_white'], 
@@ -102,22 +180,158 @@ def bucket_and_bin(df, limitations=False):
         df['income_level'] = pd.cut(df['income_lmi'], 
                                     bins=[-1e10, .5, 1.2, 1e10],
                                     labels=['Low', 'Middle', 'Upper Income'])
+    else:
+        df['income_level'] = aspirational_quartile(
+            df['median_household_income'],
+            labels=['Low', 'Middle-Lower', 'Middle-Upper', 'Upper Income'],
+        ) 
+        try:
+            df['race_quantile'] = aspirational_quartile(
+                df.race_perc_non_white, 
+                labels=race_labels
+            )
+            
+        except:
+            print(df.major_city.iloc[0])
     
     # this is our DV
-    df['is_slow'] = df.apply(
-        lambda x: 1 if x['speed_down_bins'] == "Slow (<25 Mbps)" else 0, 
-        axis=1
-    )
-   
+    df['is_slow'] = (df['speed_down_bins'] == "Slow (<25 Mbps)").astype(int)
+    
+    df.attrs['bucket_and_bin'] = {'scheme': scheme, 'rows': rows}
     return df
 
+## Aggregate cube
+# dimensions speeds are broken down by, besides "all" and "unserved".
+CUBE_DIMS = ['income_level', 'race_quantile', 'redlining_grade', 'race_perc']
+# dimensions whose bins depend on which rows are binned together.
+BINNED_DIMS = ['income_level', 'race_quantile']
+
+def race_perc_bins(n_intervals=21):
+    # the buckets of `plot_race`, in about 5% increments.
+    steps = 1 / n_intervals
+    intervals = np.arange(0, 1. +  steps, steps)
+    intervals = [np.round(_, 2) for _ in intervals]
+    intervals[-1] = 1.01
+    return intervals
+
+def count_speeds(df, dim):
+    """
+    Households in `df` by level of `dim` and speed bin, with a row for
+    every level and bin, and nulls as ''. `order` sorts the levels.
+    "all" counts every household together, and "unserved" splits
+    households with no service from the rest.
+    """
+    if dim == 'all':
+        by = pd.Categorical.from_codes(np.zeros(len(df), dtype=int), ['all'])
+    elif dim == 'unserved':
+        by = pd.Categorical.from_codes((df.speed_down == 0).astype(int), ['served', 'unserved'])
+    elif dim == 'race_perc':
+        by = pd.cut(df[RACE_COL], bins=race_perc_bins(), right=False).values
+    else:
+        by = pd.Categorical(df[dim])
+    ordered = dim != 'redlining_grade' # grades are sorted by name, across cities
+    speeds = df['speed_down_bins'] if 'speed_down_bins' in df else speed_bins(df.speed_down)
+    speeds = pd.Categorical(speeds, categories=list(speed_labels))
+    n_levels = len(by.categories)
+    n_speeds = len(speed_labels)
+    # null levels and speed bins are code 0.
+    codes = (by.codes.astype(np.int64) + 1) * (n_speeds + 1) + (speeds.codes + 1)
+    counts = np.bincount(codes, minlength=(n_levels + 1) * (n_speeds + 1))
+    order = np.arange(-1, n_levels) if ordered else np.minimum(np.arange(-1, n_levels), 0)
+    return pd.DataFrame({
+        'dimension': dim,
+        'level': np.repeat([''] + [str(c) for c in by.categories], n_speeds + 1),
+        'order': np.repeat(order, n_speeds + 1),
+        'speed_down_bins': np.tile([''] + list(speed_labels), n_levels + 1),
+        'count': counts,
+    })
+
+def build_cube(df, isp, limitations=False):
+    """
+    Counts of households by city, speed bin and each of `CUBE_DIMS`,
+    which every report chart can be drawn from, for one city or nationally.
+    `df` is every offer of `isp`, including unserved ones, which (like the 
+    report notebooks) only count towards "unserved". Income and race quartiles
+    are binned both across all cities ("national") and within each city ("city").
+    """
+    parts = []
+    def add(counts, city, binning):
+        counts['major_city'] = city
+        counts['binning'] = binning
+        parts.append(counts)
+
+    for city, _df in df.groupby('major_city'):
+        add(count_speeds(_df, 'unserved'), city, '')
+    served = bucket_and_bin(df[df.speed_down != 0], limitations=limitations)
+    dims = ['all'] + [dim for dim in CUBE_DIMS if dim in served or dim == 'race_perc']
+    for city, _df in served.groupby('major_city'):
+        for dim in dims:
+            add(count_speeds(_df, dim), city, 'national' if dim in BINNED_DIMS else '')
+        _df = bucket_and_bin(_df.copy(), limitations=limitations)
+        for dim in BINNED_DIMS:
+            add(count_speeds(_df, dim), city, 'city')
+    cube = pd.concat(parts, ignore_index=True)
+    cube['isp'] = isp
+    cols = ['isp', 'major_city', 'binning', 'dimension', 'level', 'order', 'speed_down_bins', 'count']
+    dtypes = {c: 'category' for c in cols[:5] + ['speed_down_bins']}
+    return cube[cols].astype({**dtypes, 'order': 'int8', 'count': 'int32'})
+
+def is_cube(df):
+    return 'dimension' in df and 'count' in df
+
+def get_counts(df, dim, isp=None, city=None):
+    """
+    Counts by `dim` and speed bin: from a cube, for `isp` and `city`
+    (with quartiles binned within the city) or every city, or counted 
+    from the households in `df`.
+    """
+    if not is_cube(df):
+        return count_speeds(df, dim)
+    binning = 'city' if city else 'national'
+    mask = (df.dimension == dim) & df.binning.isin([binning, ''])
+    if isp:
+        mask &= df.isp == isp
+    if city:
+        mask &= df.major_city == city
+    return df[mask]
+
+def speed_matrix(counts):
+    """
+    `counts` as a table of levels (rows, in order) by speed bin (columns),
+    summed across cities. Nulls are the '' row and column.
+    """
+    counts = counts.astype({'level': str, 'speed_down_bins': str})
+    matrix = counts.pivot_table(index=['order', 'level'], columns='speed_down_bins',
+                                values='count', aggfunc='sum', fill_value=0)
+    matrix = matrix.droplevel('order')
+    return matrix.reindex(columns=[''] + list(speed_labels), fill_value=0)
+
+def speed_shares(matrix):
+    # the share of each speed bin in each row, out of households with a known speed.
+    speeds = matrix.drop(columns='')
+    return speeds.divide(speeds.sum(axis=1), axis=0)
+
+def present_speeds(df, isp=None, city=None):
+    matrix = speed_matrix(get_counts(df, 'all', isp, city))
+    speeds = matrix.drop(columns='').sum()
+    return set(speeds[speeds > 0].index)
+
+
+## Charts
+# each chart takes a frame of households, or a cube from `build_cube` 
+# (with `city` to draw one city).
+def unserved_shares(df, isp=None):
+    # the share of households unserved in each city
+    if not is_cube(df):
+        return (df.speed_down == 0).groupby(df.major_city).mean()
+    counts = get_counts(df, 'unserved', isp).astype({'major_city': str, 'level': str})
+    totals = counts.pivot_table(index='major_city', columns='level', 
+                                values='count', aggfunc='sum', fill_value=0)
+    return totals['unserved'] / totals.sum(axis=1)
+
 def unserved(df, isp='AT&T', height=5):
     # percentage of households unserved
-    city2unserved = {}
-    for city, _df in df.groupby('major_city'):
-        city2unserved[city] = len(_df[_df.speed_down == 0]) / len(_df)
-    
-    to_plot = pd.Series(city2unserved).sort_values() * 100
+    to_plot = unserved_shares(df, isp).sort_values() * 100
     ax = to_plot.plot(
         kind='barh', figsize=(6, height), 
         width=.5,
@@ -137,12 +351,14 @@ def unserved(df, isp='AT&T', height=5):
     plt.title(f'Percentage of unserved households by {isp}',
                  loc='left', y=1.025, size=12.5)
 
-def speed_breakdown(df, location='National', isp='AT&T'):
-    categories = set(df.speed_down_bins.unique())
+def speed_breakdown(df, location='National', isp='AT&T', city=None):
+    categories = present_speeds(df, isp, city)
     legend_elements = [Line2D([0], [0], marker='o', color='w', 
                           label=label, markerfacecolor=c, markersize=10)
                    for label, c in speed_labels.items() if label in categories][::-1]   
-    to_plot =  pd.DataFrame(df.speed_down_bins.value_counts(normalize=True).sort_index())
+    matrix = speed_matrix(get_counts(df, 'all', isp, city))
+    n = matrix.values.sum()
+    to_plot = speed_shares(matrix.drop(index='')).T
     ax = to_plot.T.plot.barh(
         stacked=True, figsize=(8, 2.6), 
         color = [speed_labels.get(l) for l in to_plot.index]
@@ -173,30 +389,26 @@ def speed_breakdown(df, location='National', isp='AT&T'):
               frameon=False,
               prop={'size': 9.2})
 
-    plt.title(f'{isp} {location} Residential Download Speeds (N={len(df):,})',
+    plt.title(f'{isp} {location} Residential Download Speeds (N={n:,})',
               loc='left', y=1.075, size=15.5)
     plt.show()
 
 
-def race(df, isp='AT&T', location='National'):
-    categories = set(df.speed_down_bins.unique())
+def race(df, isp='AT&T', location='National', city=None):
+    categories = present_speeds(df, isp, city)
     legend_elements = [Line2D([0], [0], marker='o', color='w', 
                           label=label, markerfacecolor=c, markersize=10)
                    for label, c in speed_labels.items() if label in categories][::-1]   
     
-    df['color'] = df['speed_down_bins'].apply(lambda x: speed_labels.get(x))
-    
-    df = df[~df.race_perc_non_white.isnull()]
-    to_plot = (df.groupby('race_quantile').speed_down_bins
-          .value_counts(normalize=True)
-          .sort_index() * 100 ).unstack()[[
+    matrix = speed_matrix(get_counts(df, 'race_quantile', isp, city)).drop(index='')
+    to_plot = (speed_shares(matrix) * 100)[[
         c for c in speed_labels.keys() if c in categories
     ]][::-1]
     ax = to_plot.plot(
         kind='barh', stacked=True, figsize=(8, 5), 
         color = [v for k,v in speed_labels.items() if k in categories],
     )
-    bin_counts = df.race_quantile.value_counts().sort_index()[::-1]
+    bin_counts = matrix.sum(axis=1)[::-1]
 
     # Hide the right and top spines
     ax.spines['right'].set_visible(False)
@@ -221,7 +433,7 @@ def race(df, isp='AT&T', location='National'):
               prop={'size': 9.2})
 
     plt.title(f'{isp} {location} Residential Download Speeds by \n'
-              f'Block Group Racial and Ethnic Demographics (N={len(df):,})',
+              f'Block Group Racial and Ethnic Demographics (N={bin_counts.sum():,})',
               loc='left', y=1.075, size=15.5)
     # label counts
     rects = ax.patches
@@ -236,21 +448,16 @@ def race(df, isp='AT&T', location='National'):
 
     plt.show()
     
-def income(df, isp="AT&T", location="National"):
-    categories = set(df.speed_down_bins.unique())
+def income(df, isp="AT&T", location="National", city=None):
+    categories = present_speeds(df, isp, city)
     legend_elements = [Line2D([0], [0], marker='o', color='w', 
                           label=label, markerfacecolor=c, markersize=10)
                    for label, c in speed_labels.items() if label in categories][::-1]
     
-    df['color'] = df['speed_down_bins'].apply(lambda x: speed_labels.get(x))
-#     df = df[(~df['income_lmi'].isnull()) & (df['income_lmi'] > -11808.606100)]
-    df.loc[:, 'income_level'] = df['income_level'].astype(
-         CategoricalDtype(income_labels, ordered=True)
-    ).copy(deep=True)
-    
-    to_plot = (df.groupby('income_level').speed_down_bins
-                 .value_counts(normalize=True)
-                 .sort_index() * 100 ).unstack()[
+    matrix = speed_matrix(get_counts(df, 'income_level', isp, city))
+    n = matrix.values.sum()
+    matrix = matrix.drop(index='')
+    to_plot = (speed_shares(matrix) * 100)[
         [c for c in speed_labels.keys() if c in categories]
     ]
     
@@ -259,7 +466,7 @@ def income(df, isp="AT&T", location="National"):
         color = [v for k,v in speed_labels.items() if k in categories],
     )
 
-    bin_counts = df.income_level.value_counts().sort_index()
+    bin_counts = matrix.sum(axis=1)
 
     # Hide the right and top spines
     ax.spines['right'].set_visible(False)
@@ -273,7 +480,7 @@ def income(df, isp="AT&T", location="National"):
     ax.set_xlabel("Percentage of residential Internet offers")
 
     plt.title(f'{isp} {location} Residential Download Speeds\n'
-             f'by Block Group Median Income (N={len(df):,})',
+             f'by Block Group Median Income (N={n:,})',
             loc='left',
     #          x=0.48,
              y=1.125,
@@ -304,8 +511,8 @@ def income(df, isp="AT&T", location="National"):
     
     
 
-def redlining(df, isp="AT&T", location="National"):
-    categories = set(df.speed_down_bins.unique())
+def redlining(df, isp="AT&T", location="National", city=None):
+    categories = present_speeds(df, isp, city)
     legend_elements = [
         Line2D([0], [0], marker='o', color='w', 
                label=label, markerfacecolor=c, markersize=10)
@@ -313,14 +520,13 @@ def redlining(df, isp="AT&T", location="National"):
         if label in categories
     ][::-1]    
     
-    df['color'] = df['speed_down_bins'].apply(lambda x: speed_labels.get(x))
-    df = df[(~df.redlining_grade.isnull()) & (df.redlining_grade != 'E')]
-    if df.empty:
+    matrix = speed_matrix(get_counts(df, 'redlining_grade', isp, city))
+    matrix = matrix.drop(index=['', 'E'], errors='ignore')
+    matrix = matrix[matrix.sum(axis=1) > 0]
+    if matrix.empty:
         return
     
-    to_plot = (df.groupby('redlining_grade').speed_down_bins
-                 .value_counts(normalize=True)
-                 .sort_index() * 100 ).unstack()[::-1][[
+    to_plot = (speed_shares(matrix) * 100)[::-1][[
         c for c in speed_labels.keys() if c in categories
     ]]
     
@@ -328,7 +534,7 @@ def redlining(df, isp="AT&T", location="National"):
                       color = [v for k,v in speed_labels.items() if k in categories],
     )
 
-    bin_counts = df['redlining_grade'].value_counts().sort_index()[::-1]
+    bin_counts = matrix.sum(axis=1)[::-1]
     # Hide the right and top spines
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
@@ -355,7 +561,7 @@ def redlining(df, isp="AT&T", location="National"):
               prop={'size': 9.2})
 
     plt.title(f'{isp} {location} Residential Download Speeds by \n'
-              f'Neighborhoods Historically Rated for Redlining (N={len(df):,})',
+              f'Neighborhoods Historically Rated for Redlining (N={bin_counts.sum():,})',
               loc='left',
               y=1.075,
               size=15.5)
@@ -373,39 +579,28 @@ def redlining(df, isp="AT&T", location="National"):
 
     plt.show()
     
-def plot_race(df, location='National', isp='AT&T', price="$55"):
-    categories = set(df.speed_down_bins.unique())
+def plot_race(df, location='National', isp='AT&T', price="$55", city=None):
+    categories = present_speeds(df, isp, city)
     legend_elements = [Line2D([0], [0], marker='o', color='w', 
                           label=label, markerfacecolor=c, markersize=10)
                    for label, c in speed_labels.items() if label in categories][::-1]
     n_intervals = 21
     steps = 1 / n_intervals
-    intervals = np.arange(0, 1. +  steps, steps)
-    intervals = [np.round(_, 2) for _ in intervals]
-    intervals[-1] = 1.01
-        
-    df['race_perc'] = pd.cut(df[RACE_COL], bins=intervals, right=False)
-    cuts = pd.pivot_table(
-        data = df,
-        columns = 'speed_down_bins',
-        index = 'race_perc',
-        values = ['address_full'],
-        aggfunc='count',
-        fill_value = 0,
-    )
-    cuts.sort_values(by='race_perc', inplace=True)
-    cuts = cuts.divide(cuts.sum(axis=1), axis=0)
-    cuts = cuts[[('address_full', c) for c in speed_labels.keys() if c in categories]]
+    intervals = race_perc_bins(n_intervals)
+    
+    n = speed_matrix(get_counts(df, 'all', isp, city)).values.sum()
+    matrix = speed_matrix(get_counts(df, 'race_perc', isp, city)).drop(index='')
+    cuts = speed_shares(matrix)
+    cuts = cuts[[c for c in speed_labels.keys() if c in categories]]
     data = np.cumsum(cuts.values, axis=1)
     ig, ax = plt.subplots(figsize=(8, 8))
     if cuts.isnull().values.any():
         plt.fill_between(x=[1,0], y1=[1,1], y2=.05,
                          interpolate=True, facecolor="none", zorder=-100,
                          hatch="\\\\\\\\\\", edgecolor="grey", linewidth=0.0)
-    for i, col in enumerate(cuts.columns):
-        label = col[-1]
+    for i, label in enumerate(cuts.columns):
         ax.fill_betweenx(intervals[1:], data[:, i], 
-                         label=col[-1], color=speed_labels.get(label),
+                         label=label, color=speed_labels.get(label),
                          zorder=-i)
 #         ax.plot(data[:, i], intervals[1:], 
 #                 ls="-", linewidth=1.4,
@@ -461,7 +656,7 @@ def plot_race(df, location='National', isp='AT&T', price="$55"):
     
     # titles and subtitles
     plt.title(f'{isp} {location} Residential Download Speeds by\n'
-              f'Block Group Racial and Ethnic Demographic (N={len(df):,})',
+              f'Block Group Racial and Ethnic Demographic (N={n:,})',
               loc='left', y=1.055, size=15.5)
     
     plt.text(0, 1.11, f"All prices quoted at {price}. 2019 5-year ACS data (y-axis) bucketed in 5-percent increments."
@@ -0,0 +1,156 @@
+"""
+Block-compressed NDJSON, in the spirit of BGZF.
+
+A converted file is a series of independent gzip members, each holding
+whole lines, so it's still a valid .gz file that `gzip.open` reads as usual.
+A sidecar index (`{fn}.idx`) records where each block starts, so a range of
+blocks can be parsed on its own, and a single address fetched by decompressing
+only the block it's in.
+
+    python bgzf.py convert '../data/intermediary/isp/*/*/*.geojson.gz'
+    python bgzf.py fetch 'path/to/file.geojson.gz' --address '123 Main St, ...'
+"""
+import os
+import gzip
+import json
+import zlib
+import glob
+import argparse
+
+BLOCK_BYTES = 1 << 16 # uncompressed bytes per block, like BGZF
+
+
+def index_path(fn: str) -> str:
+    return fn + '.idx'
+
+def has_index(fn: str) -> bool:
+    """
+    Whether `fn` was converted, and its index is up to date.
+    """
+    idx = index_path(fn)
+    return os.path.exists(idx) and os.path.getmtime(idx) >= os.path.getmtime(fn)
+
+def read_index(fn: str) -> dict:
+    """
+    The index of `fn`: `blocks` is a list of
+    `[offset, length, first_record, n_records]`, and `addresses`
+    is the `address_full` of each record, in order.
+    """
+    with open(index_path(fn), 'r') as f:
+        return json.load(f)
+
+def compress_block(lines: list) -> bytes:
+    return gzip.compress(b''.join(lines), mtime=0)
+
+def convert(fn: str, out_fn: str = None, block_bytes: int = BLOCK_BYTES) -> dict:
+    """
+    Rewrites the gzipped NDJSON `fn` as blocks of about `block_bytes`
+    (uncompressed) and saves its index. Converts in place by default.
+    """
+    out_fn = out_fn or fn
+    tmp = out_fn + '.tmp'
+    blocks = []
+    addresses = []
+    offset = 0
+    n_records = 0
+    with gzip.open(fn, 'rb') as f_in, open(tmp, 'wb') as f_out:
+        lines = []
+        size = 0
+        def flush():
+            nonlocal offset, lines, size
+            block = compress_block(lines)
+            f_out.write(block)
+            blocks.append([offset, len(block), n_records - len(lines), len(lines)])
+            offset += len(block)
+            lines = []
+            size = 0
+        for line in f_in:
+            if not line.strip():
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            addresses.append(json.loads(line).get('address_full'))
+            lines.append(line)
+            size += len(line)
+            n_records += 1
+            if size >= block_bytes:
+                flush()
+        if lines:
+            flush()
+    index = {'blocks': blocks, 'addresses': addresses}
+    os.replace(tmp, out_fn)
+    with open(index_path(out_fn), 'w') as f:
+        json.dump(index, f)
+    return index
+
+def read_block(f, block: list) -> list:
+    """
+    The lines in `block`, read from the open file `f`.
+    """
+    offset, length, _, _ = block
+    f.seek(offset)
+    data = zlib.decompress(f.read(length), wbits=31)
+    return data.splitlines()
+
+def iter_blocks(fn: str, start: int = 0, stop: int = None, index: dict = None):
+    """
+    Decodes the records in blocks `start` to `stop` of `fn`,
+    without reading the rest of the file.
+    """
+    index = index or read_index(fn)
+    with open(fn, 'rb') as f:
+        for block in index['blocks'][start:stop]:
+            for line in read_block(f, block):
+                yield json.loads(line)
+
+def fetch(fn: str, i: int = None, address: str = None) -> dict:
+    """
+    The `i`th record of `fn`, or the one for `address` (give one of them),
+    decompressing only the block it's in.
+    """
+    if (i is None) == (address is None):
+        raise ValueError("fetch needs either a record number `i` or an `address`, not "
+                         + ("both" if address is not None else "neither"))
+    index = read_index(fn)
+    if address is not None:
+        i = index['addresses'].index(address)
+    for block in index['blocks']:
+        offset, length, first, n = block
+        if first <= i < first + n:
+            with open(fn, 'rb') as f:
+                return json.loads(read_block(f, block)[i - first])
+    raise IndexError(f"{fn} has no record {i}")
+
+def split(fn: str, max_blocks: int) -> list:
+    """
+    Splits an indexed `fn` into `(start, stop)` ranges of at most `max_blocks` blocks.
+    """
+    n_blocks = len(read_index(fn)['blocks'])
+    return [(start, min(start + max_blocks, n_blocks))
+            for start in range(0, n_blocks, max_blocks)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Block-compressed NDJSON")
+    commands = parser.add_subparsers(dest='command', required=True)
+    _convert = commands.add_parser('convert', help='convert gzipped NDJSON files in place')
+    _convert.add_argument('patterns', nargs='+')
+    _convert.add_argument('--block-bytes', type=int, default=BLOCK_BYTES)
+    _fetch = commands.add_parser('fetch', help='print one record')
+    _fetch.add_argument('fn')
+    _fetch.add_argument('--address')
+    _fetch.add_argument('--i', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        from tqdm import tqdm
+        files = [fn for pattern in args.patterns for fn in glob.glob(pattern)]
+        for fn in tqdm([fn for fn in files if not has_index(fn)]):
+            convert(fn, block_bytes=args.block_bytes)
+    else:
+        if (args.i is None) == (args.address is None):
+            _fetch.error('give either --i or --address')
+        print(json.dumps(fetch(args.fn, i=args.i, address=args.address), indent=2))
+
+if __name__ == '__main__':
+    main()
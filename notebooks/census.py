@@ -0,0 +1,246 @@
+"""
+Downloads ACS 5-year estimates from the Census API, for notebook 0.
+
+Each request gets every column we need of every table for one county
+(up to the API's 50 per call), rather than one column at a time. Requests
+share one `aiohttp` session, with at most `concurrency` of them in flight,
+and are retried with exponential backoff when the API is rate limiting or
+down. Responses are cached on disk under the sha1 of their URL (without the
+API key), so re-runs, and runs that died halfway, only request what's missing.
+Point `base_url` at a local stand-in for the API to run without census.gov.
+
+    tables = download_acs(fips, acs_tables, year=2019, data_dir='../data/input/census/acs5')
+"""
+import os
+import json
+import gzip
+import random
+import asyncio
+import hashlib
+import email.utils
+import concurrent.futures
+from datetime import datetime, timezone
+from urllib.parse import urlencode, quote
+
+import aiohttp
+import pandas as pd
+from tqdm import tqdm
+
+BASE_URL = 'https://api.census.gov/data'
+# worth retrying: rate limits and server errors.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the API returns "no content" for geographies without data.
+NO_CONTENT = 204
+# the most columns the API returns in one call.
+MAX_COLUMNS = 50
+
+
+def table_columns(table: dict) -> list:
+    """
+    The ACS columns of `table` (one of notebook 0's `acs_tables`).
+    """
+    return [col for col in table['columns'] if col != 'block group']
+
+def column_chunks(tables: list) -> list:
+    """
+    The ACS columns of `tables`, in chunks of at most `MAX_COLUMNS`: one API call, per county, each.
+    """
+    columns = list(dict.fromkeys(col for table in tables for col in table_columns(table)))
+    return [columns[i:i + MAX_COLUMNS] for i in range(0, len(columns), MAX_COLUMNS)]
+
+def acs_url(base_url: str, year: int, params: dict) -> str:
+    # spaces as %20 rather than +, and the API's `:`, `*` and `,` as they are.
+    return f"{base_url}/{year}/acs/acs5?" + urlencode(params, quote_via=quote, safe=':*,')
+
+def make_request(columns: list,
+                 fip: str,
+                 year: int = 2019,
+                 geography: str = 'block group',
+                 api_key: str = None,
+                 base_url: str = BASE_URL) -> dict:
+    """
+    The request for `columns` of every `geography` in the county `fip` (state and county FIPS).
+    """
+    params = {
+        'get': ','.join(columns),
+        'for': f"{geography}:*",
+        'in': f"state:{fip[:2]} county:{fip[2:].zfill(3)}",
+    }
+    return {
+        'fip': fip,
+        'columns': columns,
+        'url': acs_url(base_url, year, params),
+        'key': api_key,
+    }
+
+## Cache
+def cache_path(cache_dir: str, url: str) -> str:
+    digest = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(cache_dir, digest[:2], f"{digest}.json.gz")
+
+def read_cache(fn: str) -> list:
+    with gzip.open(fn, 'rt') as f:
+        return json.load(f)
+
+def write_cache(fn: str, rows: list):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with gzip.open(fn + '.tmp', 'wt') as f:
+        json.dump(rows, f)
+    os.replace(fn + '.tmp', fn)
+
+## Requests
+def retry_after(value: str) -> float:
+    """
+    The seconds to wait from a Retry-After header, which is either seconds or
+    an HTTP date. 0 if there's no header, or it can't be read.
+    """
+    if not value:
+        return 0.
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0., (when - datetime.now(timezone.utc)).total_seconds())
+
+async def fetch(session: aiohttp.ClientSession,
+                semaphore: asyncio.Semaphore,
+                request: dict,
+                cache_dir: str,
+                stats: dict,
+                retries: int = 5,
+                backoff: float = 1.,
+                recalculate: bool = False) -> list:
+    """
+    The rows of one API response, header first, from the cache if it's there.
+    Empty if the county has no data, and None if the API refused the request.
+    """
+    fn = cache_path(cache_dir, request['url'])
+    if os.path.exists(fn) and not recalculate:
+        stats['cached'] += 1
+        return read_cache(fn)
+    url = request['url'] + (f"&key={request['key']}" if request['key'] else '')
+    for attempt in range(retries + 1):
+        wait = backoff * 2 ** attempt * (.5 + random.random())
+        try:
+            async with semaphore:
+                stats['requests'] += 1
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        rows = await resp.json(content_type=None)
+                        break
+                    if resp.status == NO_CONTENT:
+                        rows = []
+                        break
+                    if resp.status not in RETRY_STATUSES:
+                        text = await resp.text()
+                        print(f"{request['fip']}: {resp.status} {text[:200]}")
+                        return None
+                    wait = max(wait, retry_after(resp.headers.get('Retry-After')))
+                    error = f"status {resp.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+        if attempt == retries:
+            raise RuntimeError(f"{request['fip']}: gave up after {retries + 1} attempts ({error})")
+        stats['retries'] += 1
+        await asyncio.sleep(wait)
+    write_cache(fn, rows)
+    return rows
+
+async def fetch_all(requests: list,
+                    cache_dir: str,
+                    concurrency: int = 8,
+                    retries: int = 5,
+                    backoff: float = 1.,
+                    timeout: float = 60,
+                    recalculate: bool = False) -> tuple:
+    """
+    `fetch` for each of `requests`, over one pooled session.
+    Returns their rows, in order, and how many were requested, cached and retried.
+    """
+    stats = {'requests': 0, 'cached': 0, 'retries': 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        tasks = [asyncio.ensure_future(fetch(session, semaphore, request, cache_dir, stats,
+                                             retries, backoff, recalculate))
+                 for request in requests]
+        try:
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                await task
+        finally:
+            for task in tasks:
+                task.cancel()
+        return [task.result() for task in tasks], stats
+
+def run(coroutine):
+    """
+    Runs `coroutine` to completion, also from notebooks, whose event loop is already running.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+def to_frame(rows: list) -> pd.DataFrame:
+    """
+    An API response as numbers, like reading it back from CSV.
+    """
+    if not rows:
+        return pd.DataFrame([])
+    return pd.DataFrame(rows[1:], columns=rows[0]).apply(pd.to_numeric)
+
+def download_acs(fips: list,
+                 tables: list,
+                 year: int = 2019,
+                 geography: str = 'block group',
+                 data_dir: str = '../data/input/census/acs5',
+                 api_key: str = None,
+                 base_url: str = BASE_URL,
+                 concurrency: int = 8,
+                 retries: int = 5,
+                 backoff: float = 1.,
+                 recalculate: bool = False) -> dict:
+    """
+    The columns of each of `tables` (notebook 0's `acs_tables`) for each
+    `geography` in the counties `fips`, keyed by table name, with the API's
+    column names. Failed requests are retried up to `retries` times, waiting
+    about `backoff` seconds, doubling each time. Responses are cached in
+    `data_dir`, and requested again only if `recalculate`.
+    """
+    chunks = column_chunks(tables)
+    columns = [col for chunk in chunks for col in chunk]
+    requests = [make_request(chunk, fip, year, geography, api_key, base_url)
+                for fip in sorted(fips) for chunk in chunks]
+    cache_dir = os.path.join(data_dir, 'cache')
+    responses, stats = run(fetch_all(requests, cache_dir, concurrency, retries, backoff,
+                                     recalculate=recalculate))
+    print(f"{len(requests)} responses: {stats['cached']} from the cache, "
+          f"{stats['requests']} requests ({stats['retries']} retries)")
+
+    counties = {}
+    for request, rows in zip(requests, responses):
+        if rows:
+            counties.setdefault(request['fip'], []).append(to_frame(rows))
+        elif rows is not None:
+            print(f"no data for {request['fip']}")
+    frames = []
+    for fip, _frames in counties.items():
+        if len(_frames) < len(chunks):
+            # some of its columns were refused, so skip it like one without data.
+            continue
+        df = _frames[0]
+        for _df in _frames[1:]:
+            df = df.merge(_df, on=[col for col in _df.columns if col not in columns])
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame([], columns=columns)
+    geographies = [col for col in df.columns if col not in columns]
+    return {table['table_name']: df[geographies + table_columns(table)] for table in tables}
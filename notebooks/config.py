@@ -1,12 +1,45 @@
+import os
 import json
+from functools import lru_cache
 
-cities = []
-with open('../data/input/addresses/cities.ndjson', 'r') as f:
-    for line in f:
-        try:
-            cities.append(json.loads(line))
-        except:
-            print(line)
+# Paths are relative to this file, so they work from any directory.
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+REDLINING_DIR = os.path.join(DATA_DIR, 'input/redlining')
+HOLC_DIR = os.path.join(DATA_DIR, 'intermediary/redlining') # compiled by `holc.py`
+TREE_DIR = os.path.join(DATA_DIR, 'intermediary/trees') # ball trees saved by `distance.py`
+FILTER_DIR = os.path.join(DATA_DIR, 'intermediary/filtered') # frames cached by `aggregators.filter_df`
+CHART_DIR = os.path.join(DATA_DIR, 'output/figs/charts') # rendered by `render.py`
+fn_cities = os.path.join(DATA_DIR, 'input/addresses/cities.ndjson')
+
+@lru_cache(maxsize=None)
+def load_cities() -> list:
+    """
+    The cities we collected addresses from, read the first time they're needed.
+    """
+    cities = []
+    with open(fn_cities, 'r') as f:
+        for line in f:
+            try:
+                cities.append(json.loads(line))
+            except:
+                print(line)
+    return cities
+
+@lru_cache(maxsize=None)
+def city2state() -> dict:
+    """
+    Maps each lowercase city name to its state.
+    """
+    lookup = {}
+    for city in load_cities():
+        lookup.setdefault(city['city'].lower(), city['state'])
+    return lookup
+
+def __getattr__(name: str):
+    # `cities` is loaded lazily, on first access.
+    if name == 'cities':
+        return load_cities()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
             
 inc_city_att = [
     'Atlanta city',
@@ -145,45 +178,45 @@ city2ap = {
 }
 
 state2redlining = {
-    'TX': ['../data/input/redlining/TXHouston19XX.geojson'],
-    'CA': ['../data/input/redlining/CALosAngeles1939.geojson'],
-    'LA': ['../data/input/redlining/LANewOrleans1939.geojson'],
-    'KS': ['../data/input/redlining/KSWichita1937.geojson'],
-    'IA': ['../data/input/redlining/IADesMoines19XX.geojson'],
-#     'OH': ['../data/input/redlining/OHCleveland1939.geojson'],
-    'OH': ['../data/input/redlining/OHColumbus1936.geojson'],
-    'WV': ['../data/input/redlining/WVCharleston1938.geojson'],
-    'AR': ['../data/input/redlining/ARLittleRock19XX.geojson'],
-    'AZ': ['../data/input/redlining/AZPhoenix19XX.geojson'],
-    'OR': ['../data/input/redlining/ORPortland1937.geojson'],
-    'PA': ['../data/input/redlining/PAPhiladelphia1937.geojson'],
-    'KY': ['../data/input/redlining/KYLouisville1938.geojson'],
-    'MD': ['../data/input/redlining/MDBaltimore1937.geojson'],
-    'WI': ['../data/input/redlining/WIMilwaukeeCo1937.geojson'],
-    'IN': ['../data/input/redlining/INIndianapolis1937.geojson'],
-    'NE': ['../data/input/redlining/NEOmaha19XX.geojson'],
-    'FL': ['../data/input/redlining/FLJacksonville1937.geojson'],
-    'MI': ['../data/input/redlining/MIDetroit1939.geojson'],
-    'IL': ['../data/input/redlining/ILChicago1940.geojson'],
-    'UT': ['../data/input/redlining/UTSaltLakeCity19XX.geojson'],
-    'MA': ['../data/input/redlining/MABoston1938.geojson'],
-    'GA': ['../data/input/redlining/GAAtlanta1938.geojson'],
-    'RI': ['../data/input/redlining/RIProvidence19XX.geojson'],
-    'NJ': ['../data/input/redlining/NJEssexCo1939.geojson'],
-    'CO': ['../data/input/redlining/CODenver1938.geojson'],
-    'MN': ['../data/input/redlining/MNMinneapolis1937.geojson'],
-    'WA': ['../data/input/redlining/WASeattle1936.geojson'],
-    'MO': ['../data/input/redlining/MOGreaterKansasCity1939.geojson'],
-    'MS': ['../data/input/redlining/MSJackson19XX.geojson'],
-    'NC': ['../data/input/redlining/NCCharlotte1935.geojson'],
-#     'TN': ['../data/input/redlining/TNMemphis19XX.geojson'],
-    'TN': ['../data/input/redlining/TNNashville19XX.geojson'],
+    'TX': [f'{REDLINING_DIR}/TXHouston19XX.geojson'],
+    'CA': [f'{REDLINING_DIR}/CALosAngeles1939.geojson'],
+    'LA': [f'{REDLINING_DIR}/LANewOrleans1939.geojson'],
+    'KS': [f'{REDLINING_DIR}/KSWichita1937.geojson'],
+    'IA': [f'{REDLINING_DIR}/IADesMoines19XX.geojson'],
+#     'OH': [f'{REDLINING_DIR}/OHCleveland1939.geojson'],
+    'OH': [f'{REDLINING_DIR}/OHColumbus1936.geojson'],
+    'WV': [f'{REDLINING_DIR}/WVCharleston1938.geojson'],
+    'AR': [f'{REDLINING_DIR}/ARLittleRock19XX.geojson'],
+    'AZ': [f'{REDLINING_DIR}/AZPhoenix19XX.geojson'],
+    'OR': [f'{REDLINING_DIR}/ORPortland1937.geojson'],
+    'PA': [f'{REDLINING_DIR}/PAPhiladelphia1937.geojson'],
+    'KY': [f'{REDLINING_DIR}/KYLouisville1938.geojson'],
+    'MD': [f'{REDLINING_DIR}/MDBaltimore1937.geojson'],
+    'WI': [f'{REDLINING_DIR}/WIMilwaukeeCo1937.geojson'],
+    'IN': [f'{REDLINING_DIR}/INIndianapolis1937.geojson'],
+    'NE': [f'{REDLINING_DIR}/NEOmaha19XX.geojson'],
+    'FL': [f'{REDLINING_DIR}/FLJacksonville1937.geojson'],
+    'MI': [f'{REDLINING_DIR}/MIDetroit1939.geojson'],
+    'IL': [f'{REDLINING_DIR}/ILChicago1940.geojson'],
+    'UT': [f'{REDLINING_DIR}/UTSaltLakeCity19XX.geojson'],
+    'MA': [f'{REDLINING_DIR}/MABoston1938.geojson'],
+    'GA': [f'{REDLINING_DIR}/GAAtlanta1938.geojson'],
+    'RI': [f'{REDLINING_DIR}/RIProvidence19XX.geojson'],
+    'NJ': [f'{REDLINING_DIR}/NJEssexCo1939.geojson'],
+    'CO': [f'{REDLINING_DIR}/CODenver1938.geojson'],
+    'MN': [f'{REDLINING_DIR}/MNMinneapolis1937.geojson'],
+    'WA': [f'{REDLINING_DIR}/WASeattle1936.geojson'],
+    'MO': [f'{REDLINING_DIR}/MOGreaterKansasCity1939.geojson'],
+    'MS': [f'{REDLINING_DIR}/MSJackson19XX.geojson'],
+    'NC': [f'{REDLINING_DIR}/NCCharlotte1935.geojson'],
+#     'TN': [f'{REDLINING_DIR}/TNMemphis19XX.geojson'],
+    'TN': [f'{REDLINING_DIR}/TNNashville19XX.geojson'],
     'NY': [
-        '../data/input/redlining/NYBronx1938.geojson',
-        '../data/input/redlining/NYBrooklyn1938.geojson',
-        '../data/input/redlining/NYManhattan1937.geojson',
-        '../data/input/redlining/NYQueens1938.geojson',
-        '../data/input/redlining/NYStatenIsland1940.geojson',
+        f'{REDLINING_DIR}/NYBronx1938.geojson',
+        f'{REDLINING_DIR}/NYBrooklyn1938.geojson',
+        f'{REDLINING_DIR}/NYManhattan1937.geojson',
+        f'{REDLINING_DIR}/NYQueens1938.geojson',
+        f'{REDLINING_DIR}/NYStatenIsland1940.geojson',
     ],
 }
 
@@ -252,4 +285,9 @@ redlininggrade2name = {
     'D' : 'D - Hazardous',
 }
 
-race_labels = ['most white', 'more white', 'less white', 'least white']
\ No newline at end of file
+race_labels = ['most white', 'more white', 'less white', 'least white']
+
+# how each ISP is named in offers and charts, by its short name in `lookups.PARSERS`.
+isp2name = {'att': 'AT&T', 'cl': 'CenturyLink', 'verizon': 'Verizon', 'el': 'EarthLink'}
+# what the offers in `aggregators.plot_race` were quoted at.
+isp2price = {'AT&T': '$55', 'CenturyLink': '$50', 'Verizon': '$40', 'EarthLink': '$65'}
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+Disparities in slow speed offers between groups of households in each city.
+
+Where notebook 3 used to bin, slice and count one city at a time, once per
+IV and binning scheme, `disparity_counts` bins every city at once and counts
+the households each IV compares in a single groupby. `disparity_table`
+turns those counts into `table1_disparities_by_city`.
+"""
+import numpy as np
+import pandas as pd
+
+from aggregators import bucket_and_bin, speed_bins
+from config import speed_labels, income_labels, race_labels
+
+CITY = ['isp', 'major_city', 'state']
+SLOW = "Slow (<25 Mbps)"
+# the column each IV bins households by, and the bins of its exposure and treatment groups.
+IVS = {
+    'income': {'col': 'income_level', 'exposure': ['Low'], 'treatment': ['Upper Income']},
+    'race': {'col': 'race_quantile', 'exposure': ['least white'], 'treatment': ['most white']},
+    'redlining': {'col': 'redlining_grade', 'exposure': ['D'], 'treatment': ['A', 'B']},
+}
+# neither group can be smaller than this.
+MIN_BIN = 300
+
+col2colrename = {
+    'prop_slow_income_exposure': 'pct_slow_lower_income',
+    'prop_slow_income_treatment': 'pct_slow_upper_income',
+    'prop_slow_income_delta' : 'income_pct_pt_diff',
+    'prop_slow_race_exposure': 'pct_slow_least_white',
+    'prop_slow_race_treatment': 'pct_slow_most_white',
+    'prop_slow_race_delta' : 'race_pct_pt_diff',
+    'prop_slow_redlining_exposure': 'pct_slow_d_rated',
+    'prop_slow_redlining_treatment': 'pct_slow_ab_rated',
+    'prop_slow_redlining_delta' : 'redlining_pct_pt_diff',
+    'uniform_speed_income': 'uniform_speed',
+    'slowest_income': 'income_disparity',
+    'slowest_race': 'race_disparity',
+    'slowest_redlining': 'redlining_disparity'
+}
+back2colname = {v:k for k,v in col2colrename.items()}
+
+
+def city_quartiles(series: pd.Series, group: np.ndarray, labels: list) -> pd.Categorical:
+    """
+    `aspirational_quartile` of `series` within each `group` (integer ids, -1 for none),
+    for every group at once. Groups whose bins can't be told apart are null.
+    """
+    values = series.values.astype(float)
+    ids = np.unique(group[group >= 0])
+    edges = np.full((max(group.max(initial=-1) + 1, 1), 5), np.nan)
+    quantiles = pd.Series(values).groupby(group).quantile([0, .25, .5, .75, 1]).unstack()
+    quantiles = quantiles.reindex(ids)
+    edges[ids] = quantiles.values
+    for i in range(1, 5):
+        same = edges[:, i - 1] == edges[:, i]
+        edges[same, i - 1] -= .001
+    # like `pd.cut`, which refuses bins that aren't unique
+    unique = (np.diff(edges, axis=1) > 0).all(axis=1)
+
+    e = edges[np.maximum(group, 0)]
+    # bins are closed on the right, and the first includes its lowest edge.
+    bins = (values[:, None] > e).sum(axis=1)
+    bins[values == e[:, 0]] = 1
+    valid = (group >= 0) & unique[np.maximum(group, 0)] & (bins >= 1) & (bins <= 4)
+    return pd.Categorical.from_codes(np.where(valid, bins - 1, -1), labels)
+
+def city_bins(df: pd.DataFrame, limitations: bool = False) -> pd.DataFrame:
+    """
+    The `income_level` and `race_quantile` of every household in `df`,
+    binned within its city like `bucket_and_bin` bins one city.
+    """
+    if limitations:
+        # fixed cutoffs, so binning cities together is the same as one by one.
+        cols = ['speed_down', 'income_lmi', 'median_household_income', 'race_perc_non_white']
+        binned = bucket_and_bin(df[cols].copy(), limitations=True)
+        return binned[['income_level', 'race_quantile']]
+    group = df.groupby(CITY, sort=False).ngroup().values
+    return pd.DataFrame({
+        'income_level': city_quartiles(df['median_household_income'], group, income_labels),
+        'race_quantile': city_quartiles(df['race_perc_non_white'], group, race_labels),
+    }, index=df.index)
+
+def disparity_counts(df: pd.DataFrame, schemes: tuple = (False, True)) -> pd.DataFrame:
+    """
+    For every ISP and city in `df` (offers from `filter_df`), how many households
+    there are, at each speed, and in the exposure and treatment groups of each IV,
+    binned with and without `limitations` (`schemes`), and how many of them are slow.
+    """
+    speeds = pd.Categorical(speed_bins(df['speed_down']), categories=list(speed_labels))
+    is_slow = speeds == SLOW
+    counts = {
+        'n_all': np.ones(len(df), dtype=int),
+        'n_rated': df['redlining_grade'].notnull().values,
+        'n_minority_white': (df['race_perc_non_white'] > .5).values,
+        'n_majority_white': (df['race_perc_non_white'] < .5).values,
+    }
+    for speed in speed_labels:
+        counts[f"n_speed_{speed}"] = speeds == speed
+    for limitations in schemes:
+        bins = city_bins(df, limitations)
+        for iv, params in IVS.items():
+            values = bins[params['col']] if params['col'] in bins else df[params['col']]
+            for group in ['exposure', 'treatment']:
+                in_group = values.isin(params[group]).values
+                counts[(limitations, iv, group, 'n')] = in_group
+                counts[(limitations, iv, group, 'n_slow')] = in_group & is_slow
+    counts = pd.DataFrame(counts, index=df.index).astype(int)
+    counts = counts.groupby([df[col] for col in CITY]).sum()
+    # ISPs in the order they're in `df`, and cities in order within each.
+    return counts.reindex(df['isp'].unique(), level='isp')
+
+def disparity_table(counts: pd.DataFrame, limitations: bool = False) -> pd.DataFrame:
+    """
+    `table1_disparities_by_city` from `disparity_counts`: the share of slow
+    offers in each IV's exposure and treatment groups, and whether the exposure
+    group's is at least 5 percentage points larger, for each ISP and city.
+    """
+    n_all = counts['n_all']
+    speeds = counts[[f"n_speed_{speed}" for speed in speed_labels]]
+    shares = speeds.divide(speeds.sum(axis=1), axis=0)
+    table = pd.DataFrame(index=counts.index)
+    for iv in IVS:
+        n = {group: counts[(limitations, iv, group, 'n')] for group in ['exposure', 'treatment']}
+        n_slow = {group: counts[(limitations, iv, group, 'n_slow')] for group in ['exposure', 'treatment']}
+        exposure = (n_slow['exposure'] / n['exposure']).round(4)
+        treatment = (n_slow['treatment'] / n['treatment']).round(4)
+
+        flag = pd.Series(np.where((n['exposure'] < MIN_BIN) | (n['treatment'] < MIN_BIN),
+                                  'small bin', None), index=counts.index, dtype=object)
+        if iv == 'redlining':
+            flag[counts['n_rated'] / n_all <= .05] = 'not HOLC graded'
+        elif iv == 'race':
+            # check only cities with at least 5 percent of addresses in minority white.
+            no_diversity = (counts['n_minority_white'] / n_all <= .05) | \
+                           (counts['n_majority_white'] / n_all <= .05)
+            flag[no_diversity] = 'no diversity'
+        tested = flag.isnull()
+
+        table[f'slowest_{iv}'] = ((exposure - treatment).round(3) >= .05).where(tested)
+        table[f'prop_slow_{iv}_exposure'] = exposure.where(tested)
+        table[f'prop_slow_{iv}_treatment'] = treatment.where(tested)
+        # no difference where no exposure households are slow
+        table[f'prop_slow_{iv}_delta'] = (exposure - treatment).where(tested & (exposure != 0))
+        if iv == 'income':
+            table[f'uniform_speed_{iv}'] = (shares >= .95).any(axis=1)
+        table[f'flag_{iv}'] = flag
+
+    table = table.reset_index()
+    table['major_city'] = table['major_city'].str.title()
+    table.columns = [col2colrename.get(c, c) for c in table.columns]
+    cols = ['major_city', 'state', 'income_disparity', 'isp']
+    return table[cols + [c for c in table.columns if c not in cols]]
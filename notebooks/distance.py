@@ -0,0 +1,170 @@
+"""
+Nearest-neighbor queries between households, on haversine ball trees.
+
+Trees are saved to disk keyed on a hash of the coordinates they were fit on,
+so the same households are only ever fit once, and queries run in parallel
+chunks across threads.
+"""
+import os
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from config import TREE_DIR
+
+EARTH_RADIUS_MILES = 3958.756
+RADII_MILES = [0.25, 0.5, 1]
+
+# trees fit or loaded in this session, by key.
+_trees = {}
+
+
+def to_radians(df: pd.DataFrame) -> np.ndarray:
+    """
+    The `lat` and `lon` of each row in `df`, in radians.
+    """
+    return np.ascontiguousarray(np.deg2rad(df[['lat', 'lon']].values.astype(float)))
+
+def tree_key(points: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(points).tobytes()).hexdigest()
+
+def fit_tree(points: np.ndarray,
+             name: str = None,
+             cache_dir: str = TREE_DIR) -> BallTree:
+    """
+    A haversine `BallTree` over `points` (in radians), loaded from `cache_dir`
+    if one was already fit on the same points. `name` (e.g. "verizon_boston")
+    only makes the saved file easier to find.
+    """
+    key = tree_key(points)
+    if key in _trees:
+        return _trees[key]
+    fn = None
+    if cache_dir:
+        prefix = f"{name}-" if name else ""
+        fn = os.path.join(cache_dir, f"{prefix}{key[:16]}.pkl".replace(' ', '_'))
+    if fn and os.path.exists(fn):
+        with open(fn, 'rb') as f:
+            tree = pickle.load(f)
+    else:
+        tree = BallTree(points, metric="haversine")
+        if fn:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(fn + '.tmp', 'wb') as f:
+                pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(fn + '.tmp', fn)
+    _trees[key] = tree
+    return tree
+
+def map_chunks(func, points: np.ndarray, n_jobs: int = None, chunk_size: int = 20_000) -> list:
+    """
+    `func` of each chunk of `chunk_size` points, across `n_jobs` threads
+    (all cores, by default). Tree queries release the GIL, so threads run them in parallel.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+    if len(chunks) <= 1 or n_jobs == 1:
+        return [func(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(n_jobs) as pool:
+        return list(pool.map(func, chunks))
+
+def query_tree(tree: BallTree,
+               points: np.ndarray,
+               k: int = 1,
+               n_jobs: int = None,
+               chunk_size: int = 20_000) -> tuple:
+    """
+    The distance (in radians) and index of the `k` nearest neighbors in `tree`
+    of each of `points`, queried in chunks of `chunk_size` across `n_jobs` threads.
+    """
+    results = map_chunks(lambda chunk: tree.query(chunk, k=k, return_distance=True),
+                         points, n_jobs, chunk_size)
+    if not results:
+        return np.empty((0, k)), np.empty((0, k), dtype=int)
+    distances = np.concatenate([d for d, _ in results])
+    indices = np.concatenate([i for _, i in results])
+    return distances, indices
+
+def nearest(df: pd.DataFrame,
+            where=None,
+            k: int = 1,
+            name: str = None,
+            n_jobs: int = None,
+            cache_dir: str = TREE_DIR) -> tuple:
+    """
+    For every household in `df`, the distance in miles to, and the position in
+    `df` of, its `k` nearest households that match `where`: a boolean mask, or a
+    function of `df` that returns one (e.g. `lambda df: df.speed_down >= 200`).
+    Returns two arrays of shape `(len(df), k)`.
+    """
+    if where is None:
+        mask = np.ones(len(df), dtype=bool)
+    elif callable(where):
+        mask = np.asarray(where(df), dtype=bool)
+    else:
+        mask = np.asarray(where, dtype=bool)
+    candidates = np.flatnonzero(mask)
+    points = to_radians(df)
+    tree = fit_tree(points[candidates], name=name, cache_dir=cache_dir)
+    distances, indices = query_tree(tree, points, k=k, n_jobs=n_jobs)
+    return distances * EARTH_RADIUS_MILES, candidates[indices]
+
+## Radius features
+def count_within(tree: BallTree,
+                 points: np.ndarray,
+                 miles: float,
+                 n_jobs: int = None,
+                 chunk_size: int = 20_000) -> np.ndarray:
+    """
+    How many points in `tree` are within `miles` of each of `points`,
+    counted in chunks without listing the neighbors themselves.
+    """
+    radius = miles / EARTH_RADIUS_MILES
+    counts = map_chunks(lambda chunk: tree.query_radius(chunk, radius, count_only=True),
+                        points, n_jobs, chunk_size)
+    return np.concatenate(counts) if counts else np.array([], dtype=int)
+
+def radius_features(df: pd.DataFrame,
+                    radii: list = RADII_MILES,
+                    name: str = None,
+                    n_jobs: int = None,
+                    cache_dir: str = TREE_DIR) -> pd.DataFrame:
+    """
+    For every household in `df`, how many other households are within each
+    of `radii` miles, and how many (and what share) of them were offered
+    Blazing (≥200 Mbps) or Slow (<25 Mbps) speeds. For example,
+    `households_0_5mi`, `blazing_0_5mi` and `blazing_share_0_5mi`.
+    Returns a DataFrame with the same index as `df`.
+    """
+    points = to_radians(df)
+    speed_down = df['speed_down'].values
+    groups = {
+        'households': np.ones(len(df), dtype=bool),
+        'blazing': speed_down >= 200,
+        'slow': (speed_down >= 0.00001) & (speed_down < 25),
+    }
+    features = {}
+    for group, mask in groups.items():
+        if mask.any():
+            tree_name = f"{name}_{group}" if name else None
+            tree = fit_tree(points[mask], name=tree_name, cache_dir=cache_dir)
+        for miles in radii:
+            col = f"{group}_{miles:g}mi".replace('.', '_')
+            if not mask.any():
+                features[col] = np.zeros(len(df), dtype=int)
+                continue
+            # don't count the household itself
+            features[col] = count_within(tree, points, miles, n_jobs) - mask
+    for miles in radii:
+        suffix = f"{miles:g}mi".replace('.', '_')
+        households = features[f"households_{suffix}"]
+        for group in ['blazing', 'slow']:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                features[f"{group}_share_{suffix}"] = np.where(
+                    households > 0, features[f"{group}_{suffix}"] / households, np.nan
+                )
+    return pd.DataFrame(features, index=df.index)
@@ -0,0 +1,245 @@
+"""
+A process pool for the parsing, redlining and regression stages.
+
+An `Executor` starts its workers once, and keeps them for every `map` until
+it's closed, so modules in `preload` are only imported once per worker.
+Big read-only inputs (a city's offers, the ACS table) are passed to workers
+with `share`, instead of being pickled into every task that uses them:
+workers forked after they're shared inherit them, and otherwise they're
+written once to shared memory, as Arrow for DataFrames and .npy for arrays,
+and memory-mapped by each worker the first time it needs them. Arrays, and
+numeric columns without nulls, stay memory-mapped (and read-only); other
+columns (strings, nulls) are copied into each worker that loads the frame.
+
+A task that raises doesn't stop the rest: `map` yields a `Failure` in place
+of its result, and keeps them in `failures`.
+
+    with Executor(n_jobs=8, preload=['regression']) as executor:
+        city = executor.share(df)
+        for coefs in executor.map(fit_city, [(city, 'Omaha', isp, specs)], star=True):
+            ...
+"""
+import os
+import pickle
+import importlib
+import itertools
+import traceback
+
+import multiprocess
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from tqdm import tqdm
+
+from storage import SHM_DIR
+
+# objects shared in this process, or inherited from the parent, by key.
+_objects = {}
+_keys = itertools.count()
+
+
+class Shared:
+    """
+    A handle to an object from `Executor.share`, passed in tasks in its place.
+    Workers swap it for the object before running the task.
+    """
+    def __init__(self, key: str, fn: str = None, kind: str = None):
+        self.key = key
+        self.fn = fn
+        self.kind = kind
+
+    def get(self):
+        if self.key not in _objects:
+            if self.fn is None:
+                raise KeyError(f"{self.key} was shared after this worker started")
+            _objects[self.key] = load(self.fn, self.kind)
+        return _objects[self.key]
+
+    def __repr__(self):
+        return f"Shared({self.key!r})"
+
+
+class Failure:
+    """
+    The error a task raised, in place of its result.
+    """
+    def __init__(self, index: int, error: str, traceback: str):
+        self.index = index
+        self.error = error
+        self.traceback = traceback
+        # filled in by `Executor.map`, so the task itself isn't sent back
+        self.task = None
+
+    def __repr__(self):
+        return f"Failure(task {self.index}: {self.error})"
+
+
+def dump(obj, key: str) -> tuple:
+    """
+    Writes `obj` to shared memory, and returns the file and how to read it.
+    """
+    prefix = os.path.join(SHM_DIR, f"shared-{key}")
+    if isinstance(obj, pd.DataFrame):
+        try:
+            table = pa.Table.from_pandas(obj)
+            with pa.OSFile(prefix + '.arrow', 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            return prefix + '.arrow', 'arrow'
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # columns of mixed types are pickled instead.
+            pass
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        np.save(prefix + '.npy', obj)
+        return prefix + '.npy', 'npy'
+    with open(prefix + '.pkl', 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return prefix + '.pkl', 'pickle'
+
+def load(fn: str, kind: str):
+    if kind == 'arrow':
+        with pa.memory_map(fn) as source:
+            # a block per column, so columns Arrow can hand over without a copy aren't
+            # consolidated (copied) into one block with the rest.
+            return pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+    if kind == 'npy':
+        return np.load(fn, mmap_mode='r')
+    with open(fn, 'rb') as f:
+        return pickle.load(f)
+
+def resolve(task):
+    """
+    `task` with any `Shared` in it (or in its arguments) swapped for the object.
+    """
+    if isinstance(task, Shared):
+        return task.get()
+    if isinstance(task, (tuple, list)):
+        return type(task)(arg.get() if isinstance(arg, Shared) else arg for arg in task)
+    return task
+
+def auto_chunksize(n_tasks: int, n_jobs: int, chunks_per_worker: int = 4) -> int:
+    """
+    Like `Pool.map`: about `chunks_per_worker` chunks for each worker,
+    so tasks aren't sent one by one, but slow chunks can still even out.
+    """
+    chunksize, extra = divmod(n_tasks, n_jobs * chunks_per_worker)
+    return max(1, chunksize + bool(extra))
+
+def run_task(payload: tuple):
+    func, index, task, star = payload
+    try:
+        task = resolve(task)
+        return func(*task) if star else func(task)
+    except Exception as e:
+        return Failure(index, repr(e), traceback.format_exc())
+
+def init_worker(preload: list, initializer=None, initargs: tuple = ()):
+    for module in preload:
+        importlib.import_module(module)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class Executor:
+    """
+    A pool of `n_jobs` worker processes (all cores, by default), started
+    with `context` ("fork", "spawn", or the platform's default) on the
+    first `map` and reused until `close`. Workers import the modules in
+    `preload`, then run `initializer(*initargs)`.
+    With `n_jobs=1`, tasks run in this process, without a pool, which
+    imports `preload` and runs `initializer(*initargs)` before the first task.
+    """
+    def __init__(self,
+                 n_jobs: int = None,
+                 context: str = None,
+                 preload: list = (),
+                 initializer=None,
+                 initargs: tuple = ()):
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.context = multiprocess.get_context(context)
+        self.preload = list(preload)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.failures = []
+        self._pool = None
+        self._started = False
+        self._shared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._pool is None and self.n_jobs > 1:
+            self._pool = self.context.Pool(
+                self.n_jobs,
+                initializer=init_worker,
+                initargs=(self.preload, self.initializer, self.initargs)
+            )
+        elif self.n_jobs == 1 and not self._started:
+            # this process is the only worker.
+            init_worker(self.preload, self.initializer, self.initargs)
+        self._started = True
+
+    def share(self, obj) -> Shared:
+        """
+        Shares `obj` with the workers, which must only read it.
+        Pass the handle this returns in tasks, in place of `obj`.
+        """
+        key = f"{os.getpid()}-{next(_keys)}"
+        _objects[key] = obj
+        fn = kind = None
+        # forked workers that start after this inherit `obj`.
+        inherits = self._pool is None and self.context.get_start_method() == 'fork'
+        if self.n_jobs > 1 and not inherits:
+            fn, kind = dump(obj, key)
+        self._shared[key] = fn
+        return Shared(key, fn, kind)
+
+    def release(self):
+        """
+        Forgets every shared object, and removes them from shared memory.
+        Workers that already loaded them keep them until they're closed.
+        """
+        for key, fn in self._shared.items():
+            _objects.pop(key, None)
+            if fn and os.path.exists(fn):
+                os.remove(fn)
+        self._shared = {}
+
+    def map(self,
+            func,
+            tasks,
+            star: bool = False,
+            ordered: bool = True,
+            chunksize: int = None,
+            desc: str = None,
+            progress: bool = True):
+        """
+        Yields `func(task)` (or `func(*task)`, if `star`) of each of `tasks`,
+        in order, or as they finish if not `ordered`, with a progress bar.
+        Tasks that raise yield a `Failure`, which is also kept in `failures`.
+        """
+        tasks = list(tasks)
+        payloads = ((func, i, task, star) for i, task in enumerate(tasks))
+        self.start()
+        if self._pool is None:
+            results = map(run_task, payloads)
+        else:
+            chunksize = chunksize or auto_chunksize(len(tasks), self.n_jobs)
+            imap = self._pool.imap if ordered else self._pool.imap_unordered
+            results = imap(run_task, payloads, chunksize)
+        for result in tqdm(results, total=len(tasks), desc=desc, disable=not progress):
+            if isinstance(result, Failure):
+                result.task = tasks[result.index]
+                self.failures.append(result)
+            yield result
+
+    def close(self):
+        self.release()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
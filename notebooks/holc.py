@@ -0,0 +1,122 @@
+"""
+A compiled store of the HOLC polygons in `data/input/redlining`.
+
+The GeoJSON maps are compiled once into flat NumPy arrays:
+the exterior ring of every polygon, where each polygon's ring starts,
+its bounding box, and its grade. The arrays are saved as .npy files,
+so they can be memory-mapped instead of re-parsing GeoJSON on every run.
+
+    python holc.py          # (re)builds the store
+"""
+import os
+import glob
+import json
+
+import numpy as np
+
+from config import REDLINING_DIR, HOLC_DIR
+
+ARRAYS = ['coords', 'offsets', 'bounds', 'grades']
+
+
+def sources(redlining_dir: str = REDLINING_DIR) -> dict:
+    """
+    The size and mtime of each GeoJSON map, to tell when the store is out of date.
+    """
+    return {
+        os.path.basename(fn): [os.path.getsize(fn), os.path.getmtime(fn)]
+        for fn in sorted(glob.glob(os.path.join(redlining_dir, '*.geojson')))
+    }
+
+def build(redlining_dir: str = REDLINING_DIR, store_dir: str = HOLC_DIR) -> dict:
+    """
+    Compiles every GeoJSON map in `redlining_dir` into the store in `store_dir`.
+    Like `check_redlining` always has, each area is the exterior ring of
+    its first polygon, `coordinates[0][0]`.
+    """
+    rings = []
+    grades = []
+    labels = []
+    files = {}
+    for fn in sorted(glob.glob(os.path.join(redlining_dir, '*.geojson'))):
+        start = len(rings)
+        with open(fn, 'r') as f:
+            geojson = json.load(f)
+        for record in geojson['features']:
+            ring = np.asarray(record['geometry']['coordinates'][0][0], dtype=float)[:, :2]
+            grade = record['properties']['holc_grade']
+            if grade not in labels:
+                labels.append(grade)
+            rings.append(ring)
+            grades.append(labels.index(grade))
+        files[os.path.basename(fn)] = [start, len(rings)]
+
+    offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    coords = np.concatenate(rings) if rings else np.empty((0, 2))
+    bounds = np.array([[ring[:, 0].min(), ring[:, 1].min(),
+                        ring[:, 0].max(), ring[:, 1].max()] for ring in rings]).reshape(-1, 4)
+    arrays = {
+        'coords': coords,
+        'offsets': offsets.astype(np.int64),
+        'bounds': bounds,
+        'grades': np.array(grades, dtype=np.int16),
+    }
+    os.makedirs(store_dir, exist_ok=True)
+    # written to temporary files and moved into place, so readers never see
+    # half an array, and the index last, so the store isn't current until it's whole.
+    for name, array in arrays.items():
+        fn = os.path.join(store_dir, f'{name}.npy')
+        with open(f'{fn}.{os.getpid()}.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(f'{fn}.{os.getpid()}.tmp', fn)
+    index = {
+        'files': files,
+        'labels': labels,
+        'sources': sources(redlining_dir),
+    }
+    fn = os.path.join(store_dir, 'index.json')
+    with open(f'{fn}.{os.getpid()}.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(f'{fn}.{os.getpid()}.tmp', fn)
+    return index
+
+def is_current(redlining_dir: str = REDLINING_DIR, store_dir: str = HOLC_DIR) -> bool:
+    fn_index = os.path.join(store_dir, 'index.json')
+    if not os.path.exists(fn_index):
+        return False
+    if not all(os.path.exists(os.path.join(store_dir, f'{name}.npy')) for name in ARRAYS):
+        return False
+    with open(fn_index, 'r') as f:
+        return json.load(f)['sources'] == sources(redlining_dir)
+
+def load(redlining_dir: str = REDLINING_DIR, store_dir: str = HOLC_DIR) -> dict:
+    """
+    Memory-maps the store, building it first if it's missing or out of date.
+    """
+    if not is_current(redlining_dir, store_dir):
+        build(redlining_dir, store_dir)
+    with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+        store = json.load(f)
+    for name in ARRAYS:
+        store[name] = np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r')
+    return store
+
+def polygon_ids(store: dict, files: list) -> np.ndarray:
+    """
+    The ids of the polygons in each of `files`, in order.
+    """
+    ids = [np.arange(*store['files'][os.path.basename(fn)])
+           for fn in files if os.path.basename(fn) in store['files']]
+    return np.concatenate(ids) if ids else np.array([], dtype=int)
+
+def ring(store: dict, i: int) -> np.ndarray:
+    """
+    The exterior ring of polygon `i`.
+    """
+    return np.asarray(store['coords'][store['offsets'][i]:store['offsets'][i + 1]])
+
+
+if __name__ == '__main__':
+    index = build()
+    print(f"{sum(stop - start for start, stop in index['files'].values())} polygons "
+          f"from {len(index['files'])} maps in {HOLC_DIR}")
@@ -0,0 +1,204 @@
+"""
+Parses the lookup responses of any set of ISPs in one pass,
+through a single shared process pool.
+
+Usage:
+    python ingest.py                    # every ISP
+    python ingest.py att verizon --n-jobs 40
+    python ingest.py el --recalculate --save-plans
+"""
+import os
+import glob
+import argparse
+from functools import partial
+
+import pandas as pd
+
+from config import DATA_DIR
+from lookups import PARSERS, workflow
+from parsers import check_redlining
+from executor import Executor
+from manifest import (
+    Manifest, prune, to_parse, make_tasks, run_tasks, collect, summarize, PARSE_MODULES, BATCH_BYTES
+)
+from storage import write_offers
+
+# These are the ACS columns we merge with lookup responses.
+ACS_COLS = [
+    'geoid', 'race_perc_non_white','income_lmi',
+    'ppl_per_sq_mile', 'n_providers', 'income_dollars_below_median',
+    'internet_perc_broadband', 'median_household_income'
+]
+
+
+def get_paths(isp: str, data_dir: str = DATA_DIR) -> dict:
+    """
+    Where the lookup responses for `isp` are read from, and its outputs are saved.
+    """
+    name = PARSERS[isp]['name']
+    return {
+        'pattern': os.path.join(data_dir, f'intermediary/isp/{name}/*/*.geojson.gz'),
+        'partitions': os.path.join(data_dir, f'intermediary/parsed/{isp}'),
+        'manifest': os.path.join(data_dir, f'intermediary/parsed/{isp}/manifest.json'),
+        'offers': os.path.join(data_dir, f'output/speed_price_{name}.csv.gz'),
+        'plans': os.path.join(data_dir, f'output/plans_{name}.csv.gz'),
+    }
+
+## Cleaning
+def pad_block_group(df: pd.DataFrame) -> pd.DataFrame:
+    df['block_group'] = df['block_group'].apply(lambda x: f"{int(x):012d}")
+    return df
+
+def drop_940(df: pd.DataFrame) -> pd.DataFrame:
+    # CenturyLink lists 940 Mbps plans, which we leave out.
+    return df[df.speed_down != 940]
+
+# ISP-specific steps, after filtering to incorporated cities.
+CLEAN = {
+    'att': pad_block_group,
+    'cl': drop_940,
+    'el': pad_block_group,
+}
+
+def process_offers(df: pd.DataFrame,
+                   isp: str,
+                   acs: pd.DataFrame,
+                   n_jobs: int = 1) -> pd.DataFrame:
+    """
+    Keeps addresses in the incorporated cities we collected for `isp`,
+    checks HOLC-grades for each address (a state per task, across `n_jobs`
+    processes), and merges census data.
+    """
+    df = df[df.incorporated_place.isin(PARSERS[isp]['inc_city'])]
+    if isp in CLEAN:
+        df = CLEAN[isp](df)
+    df = check_redlining(df, n_jobs=n_jobs)
+    df = df.merge(acs[ACS_COLS], how='left',
+                  left_on='block_group', right_on='geoid')
+    return df[[c for c in df.columns if c != 'geoid']]
+
+## Ingest
+def ingest(isps: list = None,
+           data_dir: str = DATA_DIR,
+           n_jobs: int = 20,
+           recalculate: bool = False,
+           include_plans: bool = False,
+           save_every: int = 500,
+           max_blocks: int = 256,
+           batch_bytes: int = BATCH_BYTES) -> dict:
+    """
+    Parses the block groups of each ISP in `isps` that are new or changed
+    since the last run, with one process pool shared by every ISP.
+    Each ISP with new results is filtered, checked for redlining, merged with
+    census data and saved. Returns the processed offers of those ISPs.
+    Files converted with `bgzf` are parsed `max_blocks` blocks per task,
+    so big block groups are spread across workers. Tasks start biggest
+    first, and block groups under `batch_bytes` are parsed in batches.
+    """
+    isps = isps or list(PARSERS)
+    manifests = {}
+    files = {}
+    tasks = []
+    for isp in isps:
+        paths = get_paths(isp, data_dir)
+        manifest = Manifest(paths['manifest'])
+        files[isp] = glob.glob(paths['pattern'])
+        if not files[isp]:
+            print(f"{isp}: no lookup responses in {paths['pattern']}")
+            continue
+        if recalculate:
+            manifest.clear()
+        elif (os.path.exists(paths['offers']) and
+                (os.path.exists(paths['plans']) or not include_plans) and
+                os.path.exists(manifest.fn) and
+                not (to_parse(manifest, files[isp], include_plans) or 
+                     manifest.removed(files[isp]))):
+            # already up to date. Without a manifest (e.g. outputs from before
+            # there were manifests), every file is parsed once to write one.
+            continue
+        prune(manifest, files[isp])
+        manifests[isp] = manifest
+        tasks.extend(make_tasks(to_parse(manifest, files[isp], include_plans),
+                                partial(workflow, isp=isp),
+                                paths['partitions'],
+                                include_plans,
+                                max_blocks))
+
+    if tasks:
+        # files are unique across ISPs, so results find their way back by name.
+        fn2isp = {fn: isp for isp in manifests for fn in files[isp]}
+        with Executor(n_jobs, preload=PARSE_MODULES) as executor:
+            run_tasks(executor, tasks, lambda fn: manifests[fn2isp[fn]], save_every, batch_bytes)
+    for manifest in manifests.values():
+        manifest.save()
+    if not manifests:
+        return {}
+
+    acs = pd.read_csv(os.path.join(data_dir, 'intermediary/census/aggregated_tables_plus_features.csv.gz'),
+                      dtype={'geoid': str, 'block_group': str})
+    output = {}
+    for isp, manifest in manifests.items():
+        paths = get_paths(isp, data_dir)
+        offers = collect(manifest, files[isp], include_plans)
+        if include_plans:
+            offers, plans = offers
+            plans.to_csv(paths['plans'], index=False, compression='gzip')
+            del plans
+        offers = process_offers(offers, isp, acs, n_jobs)
+        offers.to_csv(paths['offers'], index=False, compression='gzip')
+        write_offers(offers, os.path.join(data_dir, 'output/speed_price'))
+        output[isp] = offers
+    return output
+
+def get_stats(isps: list = None, data_dir: str = DATA_DIR) -> pd.DataFrame:
+    """
+    Row counts for each ISP, added up from what the parse workers
+    recorded in the manifests, so the raw files aren't read again:
+    - `lines`: lookups in the raw files
+    - `collected`: lookups with `collection_status != 0`
+    - `successful`: lookups that pass the ISP's success predicate, and were parsed
+    - `skipped`: lookups that didn't
+    - `failures`: files (or parts of block-compressed files) that failed to parse
+    """
+    stats = {}
+    for isp in isps or PARSERS:
+        paths = get_paths(isp, data_dir)
+        manifest = Manifest(paths['manifest'])
+        stats[isp] = summarize(manifest, glob.glob(paths['pattern']))
+    cols = ['files', 'lines', 'collected', 'successful', 'skipped', 'failures']
+    return pd.DataFrame.from_dict(stats, orient='index').reindex(columns=cols).fillna(0).astype(int)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('isps', nargs='*', metavar='isp',
+                        help=f"ISPs to parse: {', '.join(PARSERS)} (default: all of them)")
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--n-jobs', type=int, default=20)
+    parser.add_argument('--recalculate', action='store_true',
+                        help='re-parse every file, not only the new or changed ones')
+    parser.add_argument('--save-plans', action='store_true',
+                        help='also save every plan offered to each address')
+    parser.add_argument('--max-blocks', type=int, default=256,
+                        help='blocks per task for files converted with bgzf.py')
+    parser.add_argument('--batch-bytes', type=int, default=BATCH_BYTES,
+                        help='parse block groups smaller than this (compressed) in batches')
+    args = parser.parse_args()
+    for isp in args.isps:
+        if isp not in PARSERS:
+            parser.error(f"unknown ISP {isp!r}, choose from {', '.join(PARSERS)}")
+
+    output = ingest(args.isps,
+                    data_dir=args.data_dir,
+                    n_jobs=args.n_jobs,
+                    recalculate=args.recalculate,
+                    include_plans=args.save_plans,
+                    max_blocks=args.max_blocks,
+                    batch_bytes=args.batch_bytes)
+    for isp in args.isps or PARSERS:
+        n = len(output[isp]) if isp in output else 'unchanged'
+        print(f"{isp}: {n}")
+    print(get_stats(args.isps, args.data_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,680 @@
+"""
+Parses lookup responses into offers.
+
+This is all the parse workers need, so it only imports the standard library
+up front. pandas is imported by the functions that build DataFrames,
+and config tables are loaded the first time they're used.
+"""
+import gzip
+import json
+from functools import partial
+
+import bgzf
+import config
+from config import (
+    name2speed_el,
+    inc_city_att,
+    inc_city_cl,
+    inc_city_verizon,
+    inc_city_el
+)
+
+
+## Reading
+def iter_ndjson(fn: str):
+    """
+    Decodes a gzipped newline-delimited JSON file one line at a time,
+    so only the current record is ever held in memory.
+    """
+    with gzip.open(fn, 'rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+def read_ndjson(fn: str):
+    return list(iter_ndjson(fn))
+
+def iter_rows(fn: str, blocks: tuple = None):
+    """
+    The records of `fn`, or only those in the `(start, stop)` range
+    of `blocks` if `fn` was block-compressed by `bgzf.convert`.
+    """
+    if blocks is None:
+        return iter_ndjson(fn)
+    return bgzf.iter_blocks(fn, *blocks)
+
+## Census Geocoding
+def get_incorporated_places(row: dict):
+    places = []
+    if row['geography'].get('places'):
+        places = row['geography'].get('places', {}).get('geographies', {}).get('Incorporated Places', [])
+    elif row.get('geography_places'):
+        places = row.get('geography_places').get('Incorporated Places', [])
+    return '|'.join([_.get('NAME') for _ in places])
+
+def get_state(row: dict):
+    places = []
+    if row['geography'].get('places'):
+        places = row['geography'].get('places', {}).get('geographies', {}).get('States', [])
+    elif row.get('geography_places'):
+        places = row.get('geography_places').get('States', [])
+    return '|'.join([_.get('STUSAB') for _ in places])
+
+## Plan table
+def iter_batches(records, batch_size: int = 1000):
+    """
+    Groups any iterable of records into lists of at most `batch_size`.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def select_plans(plans: 'pd.DataFrame') -> 'pd.DataFrame':
+    """
+    Picks the cheapest plan for every `address_id` in a long plan table,
+    along with the speed and price of that address's fastest plan.
+    Ties go to whichever plan the ISP listed first (`plan_rank`).
+    """
+    cheapest = (plans.sort_values(by=['address_id', 'price', 'plan_rank'], 
+                                  kind='mergesort')
+                     .drop_duplicates(subset='address_id')
+                     .set_index('address_id'))
+    fastest = (plans.sort_values(by=['address_id', 'speed_down', 'plan_rank'],
+                                 ascending=[True, False, True],
+                                 kind='mergesort')
+                    .drop_duplicates(subset='address_id')
+                    .set_index('address_id'))
+    cheapest = cheapest.drop(columns='plan_rank')
+    cheapest['fastest_speed_down'] = fastest['speed_down']
+    cheapest['fastest_speed_price'] = fastest['price']
+    return cheapest
+
+def parse_offers(rows: list, 
+                 parse_address, 
+                 get_plans, 
+                 fn: str = None,
+                 include_plans: bool = False):
+    """
+    Flattens the plans offered to each row into one long plan table keyed
+    by the row's position, then selects the cheapest and fastest plans for
+    every address at once instead of building a DataFrame per address.
+    Rows without any plans get their ISP's fallback offer.
+    If `include_plans`, also returns the full plan table.
+    """
+    import pandas as pd
+
+    records = []
+    plans = []
+    no_offers = {}
+    for i, row in enumerate(rows):
+        records.append(parse_address(row))
+        _plans, no_offer = get_plans(row)
+        if _plans:
+            for rank, plan in enumerate(_plans):
+                plans.append({'address_id': i, 'plan_rank': rank, **plan})
+        else:
+            no_offers[i] = no_offer
+    records = pd.DataFrame(records)
+    plans = pd.DataFrame(plans)
+    
+    offers = []
+    if not plans.empty:
+        offers.append(select_plans(plans))
+    if no_offers:
+        offers.append(pd.DataFrame.from_dict(no_offers, orient='index'))
+    if offers:
+        records = records.join(pd.concat(offers).sort_index())
+    records['fn'] = fn
+    if not include_plans:
+        return records
+    
+    if not plans.empty:
+        plans = (records[['address_full', 'major_city', 'block_group', 'provider']]
+                    .join(plans.set_index('address_id'), how='inner')
+                    .reset_index(drop=True))
+        plans['fn'] = fn
+    return records, plans
+
+def count_rows(rows, is_success, stats: dict):
+    """
+    Passes on the rows that pass `is_success`, counting in `stats` how many
+    `lines` were read, how many were `collected` (`collection_status != 0`),
+    and how many were `successful` or `skipped` by `is_success`.
+    """
+    for key in ['lines', 'collected', 'successful', 'skipped']:
+        stats.setdefault(key, 0)
+    for row in rows:
+        stats['lines'] += 1
+        if row['collection_status'] != 0:
+            stats['collected'] += 1
+        if is_success(row):
+            stats['successful'] += 1
+            yield row
+        else:
+            stats['skipped'] += 1
+
+def iter_offers(fn: str, 
+                is_success, 
+                parse_address, 
+                get_plans,
+                batch_size: int = 1000,
+                include_plans: bool = False,
+                stats: dict = None,
+                blocks: tuple = None):
+    """
+    Streams the successful rows of `fn` (or its `blocks`) through 
+    `parse_offers`, `batch_size` rows at a time, counting rows in `stats`
+    as it goes.
+    """
+    stats = {} if stats is None else stats
+    rows = count_rows(iter_rows(fn, blocks), is_success, stats)
+    for batch in iter_batches(rows, batch_size):
+        yield parse_offers(batch, parse_address, get_plans, 
+                           fn=fn, include_plans=include_plans)
+
+def concat_offers(batches, include_plans: bool = False):
+    """
+    Combines the batches from `iter_offers` into one result.
+    """
+    import pandas as pd
+
+    batches = list(batches)
+    if not include_plans:
+        return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+    if not batches:
+        return pd.DataFrame(), pd.DataFrame()
+    offers, plans = zip(*batches)
+    return (pd.concat(offers, ignore_index=True), 
+            pd.concat(plans, ignore_index=True))
+
+def cheapest_plan(plans: list, no_offer: dict) -> 'pd.Series':
+    """
+    The cheapest (and fastest) plan for a single address.
+    """
+    import pandas as pd
+
+    if not plans:
+        return pd.Series(no_offer)
+    plans = pd.DataFrame(plans)
+    plans['address_id'] = 0
+    plans['plan_rank'] = range(len(plans))
+    return select_plans(plans).iloc[0]
+
+## ATT
+# https://about.att.com/sites/broadband/performance
+def plans_att(row: dict) -> tuple:
+    """
+    Parse each offer from AT&T's API, 
+    and return them with the offer to fall back on if there are none.
+    """
+    no_offer = dict(
+        speed_down = 0,
+        speed_up = 0,
+        speed_unit = "",
+        price = None,
+        technology = None,
+        package = None,
+        fastest_speed_down = 0,
+        fastest_speed_price = 0
+    )
+    plans = []
+    try:
+        if row.get('offer_att'):
+            row = row['offer_att']
+            if isinstance(row, dict):
+
+                is_fiber = (row.get('content', {})
+                               .get("serviceAvailability", {})
+                               .get("availableServices", {}).get("fiberAvailable"))
+                internet = row.get('content', {}).get('baseOffers', {}).get('broadband')
+
+                if internet:
+                    for plan in internet['basePlans']:
+                        offer = plan['product']
+                        package = offer['shortDisplayName']
+                        speed_unit = offer['downloadSpeed']['uom']
+                        speed_down = offer['downloadSpeed']['speed']
+                        speed_up = offer['uploadSpeed']['speed'] if 'FIBER' not in package else speed_down
+                        if speed_unit == 'Kbps':
+                            speed_down = speed_down * .001
+                            speed_up = speed_up * .001
+                            speed_unit = 'Mbps'
+                        plans.append({
+                            'speed_down': speed_down,
+                            'speed_up': speed_up,
+                            'speed_unit': speed_unit,
+                            'price': offer['price']['netPrice'],
+                            'technology': 'Fiber' if is_fiber else 'Not Fiber',
+                            'package': package,
+                        })
+    except Exception as e:
+        plans = []
+    return plans, no_offer
+
+def get_cheapest_speed_att(row: dict):
+    """
+    Parse each offer from AT&T's API, and return the cheapest one.
+    """
+    return cheapest_plan(*plans_att(row))
+
+def address_att(row: dict):
+    lon, lat =  row['geometry']['coordinates']
+    incorporated_place = get_incorporated_places(row)
+
+    return {
+        "address_full": row['address_full'],
+        "incorporated_place" : incorporated_place,
+        "major_city": row['major_city'],
+        "state" : get_state(row),
+        "lat": lat,
+        "lon": lon,
+#         "availability_status" : row.get('availability_status'),
+        "block_group": str(row['block_group']),
+        "collection_datetime": row['collection_datetime'],
+        'provider': 'AT&T'
+    }
+
+def parse_att(row: dict):
+    record = address_att(row)
+    speeds = dict(get_cheapest_speed_att(row))        
+    record = {**record, **speeds}
+    return record
+
+def att_workflow(fn: str, include_plans: bool = False, stats: dict = None):
+    return workflow(fn, 'att', include_plans=include_plans, stats=stats)
+
+
+## CL
+def plans_cl(row: dict) -> tuple:
+    """
+    Parse each offer from CenturyLink's API,
+    and return them with the offer to fall back on if there are none.
+    """
+    no_offer = {
+        'speed_down': 0,
+        'speed_up': 0,
+        'speed_unit': 'Mbps',
+        'price': None,
+        'technology': None,
+        'package': None,
+        'fastest_speed_down': 0,
+        'fastest_speed_price': 0
+    }
+    offers = []
+    if isinstance(row['offer_centurylink'], dict):
+        if row['offer_centurylink'].keys():            
+            offer_list = row['offer_centurylink'].get('offersList')
+            for offer in offer_list:  
+                speed_down = float(offer['downloadSpeedMbps'])
+                speed_up = float(offer['uploadSpeedMbps'])
+                offers.append({
+                    'speed_down': speed_down,
+                    'speed_up': speed_up,
+                    'speed_unit': 'Mbps',
+                    'price': offer.get('price'),
+                    'technology': 'Fiber' if speed_down == speed_up else 'Not Fiber',
+                    'package': offer['offerName']
+                })
+    return offers, no_offer
+
+def get_cheapest_speed_cl(row: dict):
+    """
+    Parse each offer from CenturyLink's API, and return the cheapest one.
+    """
+    return cheapest_plan(*plans_cl(row))
+
+
+def address_cl(row: dict):
+    lon, lat =  row['geometry']['coordinates']
+    incorporated_place = get_incorporated_places(row)
+
+    return {
+        "address_full": row['address_full'],
+        "incorporated_place" : incorporated_place,
+        "major_city": row['major_city'],
+        "state" : config.city2state()[row['major_city']],
+        "lat": lat,
+        "lon": lon,
+#         "availability_status" : row.get('availability_status'),
+        "block_group": str(row['block_group']),
+        "collection_datetime": row['collection_datetime'],
+        'provider': 'CenturyLink'
+
+    }
+
+def parse_cl(row: dict):
+    record = address_cl(row)
+    speeds = dict(get_cheapest_speed_cl(row))
+    record = {**record, **speeds}
+    return record
+
+def cl_workflow(fn: str, include_plans: bool = False, stats: dict = None):
+    return workflow(fn, 'cl', include_plans=include_plans, stats=stats)
+    
+    
+## Verizon
+def plans_hsi(row: dict) -> list:
+    """
+    Lists the offers by Verizon's HSI service.
+    Verizon has a different API response for High-Speed Internet (HSI)
+    than for Fios.
+    Plans are listed fastest first, so the cheapest HSI offer is
+    the fastest one at that price.
+    """
+    plans = []
+    products = row['offer_verizon']['PrdServices']
+    for service in products:
+        service_name = service['Name']
+        if "Internet" in service_name:
+            service_name = service['ServiceDesc']
+            speeds = service["UKey"]
+            speed_down, speed_up = speeds.split('_')
+            # speed converted to Mbps
+            speed_down = int(speed_down) * .000001
+            speed_up = int(speed_up) * .000001
+            internet = dict(
+                speed_down = speed_down,
+                speed_up = speed_up,
+                speed_unit = 'Mbps',
+                price = service['Price'],
+                technology = "Not fiber",
+                package = "HSI " + service_name
+            )
+            plans.append(internet)
+    if not plans:
+        raise ValueError("no HSI internet plans offered")
+    return sorted(plans, key=lambda plan: plan['speed_down'], reverse=True)
+
+def get_cheapest_speed_hsi(row: dict):
+    """
+    Return cheapest offer by Verizon's HSI service.
+    """
+    return cheapest_plan(plans_hsi(row), {})
+
+def plans_fios(row: dict) -> list:
+    """
+    Lists the offers for Fios based on API response from Verizon.
+    Note: We assume symmetrical speeds for Fiber.
+    """
+    plans = []
+    products = row['offer_verizon']['data'].get('products', [])    
+    for service in products:
+        try:
+            service_name = service['name']
+            internet = dict(
+                speed_down = float(service['downSpeed'].rstrip('M')),
+                speed_up = float(service['downSpeed'].rstrip('M')),
+                speed_unit = 'Mbps',
+                price = float(service['displayPrice'].replace('$', '')),
+                technology = "Fiber",
+                package = "FiOS " + service_name
+            )
+            plans.append(internet)
+        except Exception as e:
+            print(service['name'], e)
+    return plans
+
+def get_cheapest_speed_fios(row: dict):
+    """
+    Get cheapest offer for Fios based on API response from Verizon.
+    """
+    return cheapest_plan(*plans_verizon(row))
+
+def plans_verizon(row: dict) -> tuple:
+    """
+    Lists Fios or HSI offers, depending on which API responded,
+    with the offer to fall back on if there are none.
+    """
+    offer = row.get('offer_verizon')
+    if not offer or isinstance(offer, float):
+        return [], {
+            'speed_down': 0, 'speed_up': 0, 'price': None,
+            'fastest_speed_down': 0, 'fastest_speed_price': 0
+        }
+    elif offer.get('data'):
+        return plans_fios(row), {
+            'speed_down': 0, 'speed_up': 0, 'price': None, 'package':'FiOS',
+            'fastest_speed_down': 0, 'fastest_speed_price': 0
+        }
+    elif offer.get('PrdServices'):
+        return plans_hsi(row), {}
+    raise ValueError("unrecognized Verizon offer")
+    
+def get_cheapest_speed_verizon(row: dict):
+    return cheapest_plan(*plans_verizon(row))
+    
+def address_verizon(row: dict, include_offer_meta = False):
+    lon, lat =  row['geometry']['coordinates']
+    incorporated_place = get_incorporated_places(row)
+    in_service = (row.get('availability_qualifications', {})
+                     .get('data', {})
+                     .get('inService'))
+    record = {
+        "address_full": row['address_full'],
+        "incorporated_place" : incorporated_place,
+        "major_city": row['major_city'],
+        "state" : get_state(row),
+        "lat": lat,
+        "lon": lon,
+#         "availability_status" : row.get('availability_status'),
+        "block_group": str(row['block_group']),
+        "collection_datetime": row['collection_datetime'],
+        'in_service' : True if in_service == 'Y' else False,
+        'provider': 'Verizon'
+
+    }
+    if include_offer_meta:
+        record['offer'] = row.get('offer_verizon')
+    return record
+
+def parse_verizon(row: dict, include_offer_meta = False):
+    record = address_verizon(row)
+    speeds = dict(get_cheapest_speed_verizon(row))
+    record = {**record, **speeds}
+    if include_offer_meta:
+        record['offer'] = row.get('offer_verizon')
+    return record
+
+def verizon_workflow(fn: str, 
+                     include_offer_meta=False, 
+                     include_plans: bool = False, 
+                     stats: dict = None):
+    return workflow(fn, 'verizon', include_offer_meta, include_plans=include_plans, stats=stats)
+
+## EarthLink
+def plans_el(row: dict) -> tuple:
+    """
+    Parse each offer from EarthLink's API,
+    and return them with the offer to fall back on if there are none.
+    """
+    if not isinstance(row['offers_earthlink'], dict):
+        return [], {
+            "price": None, "download_speed": 0, "speed_unit": None,
+            "upload_speed":0, "technology": None, "plan_name": None
+        }
+    no_offer = {
+        "price": None, "speed_down": 0, "speed_up":0,
+        "speed_unit": None, "technology": None, "package": None,
+        "fastest_speed_down": 0, "fastest_speed_price": 0
+    }
+    offers = row['offers_earthlink']['products']
+    plans = []
+    if offers:
+        providers = row['offers_earthlink'].get("extendedInfo")
+        if providers:
+            providers = providers.get("serviceableService", [])
+            code2meta = {
+                _.get("level"): _ for _ in providers
+            }
+        else:
+            code2meta = {}
+        
+        for offer in offers:
+            service_name = offer['serviceName']
+            serv_level = offer["servLevel"]
+            provider = (code2meta.get(serv_level, {})
+                                 .get("vendor", "").replace(" IMA", ""))
+            technology = code2meta.get(serv_level, {}).get("servLineType")
+            plans.append(dict(
+                price=float(offer['price'].lstrip('$')),
+                speed_down= float(name2speed_el.get(service_name.lower(), service_name)),
+                speed_up = int(offer['upstreamSpd']) / 1000,
+                speed_unit = "Mbps",
+                technology=technology,
+                package=service_name,
+                contract_provider = provider
+            ))
+    return plans, no_offer
+
+def get_cheapest_speed_el(row: dict):
+    """
+    Parse each offer from EarthLink's API, and return the cheapest one.
+    """
+    return cheapest_plan(*plans_el(row))
+    
+    
+def address_el(row: dict, include_offer_meta=False):
+    lon, lat =  row['geometry']['coordinates']
+    incorporated_place = get_incorporated_places(row)
+
+    record = {
+        "address_full": row['address_full'],
+        "incorporated_place" : incorporated_place,
+        "major_city": row['major_city'],
+        "state" : get_state(row),
+        "lat": lat,
+        "lon": lon,
+#         "availability_status" : row.get('availability_status'),
+        "block_group": str(row['block_group']),
+        "collection_datetime": row['collection_datetime'],
+        'provider': 'EarthLink'
+
+    }
+    if include_offer_meta:
+        record['offers_earthlink'] = row['offers_earthlink']
+    return record
+
+def parse_el(row: dict, include_offer_meta=False):
+    record = address_el(row)
+    speeds = dict(get_cheapest_speed_el(row))
+    record = {**record, **speeds}
+    if include_offer_meta:
+        record['offers_earthlink'] = row['offers_earthlink']
+    
+    return record
+
+def el_workflow(fn: str, 
+                include_offer_meta=False, 
+                include_plans: bool = False, 
+                stats: dict = None):
+    return workflow(fn, 'el', include_offer_meta, include_plans=include_plans, stats=stats)
+
+
+## Registry
+def collected(row: dict) -> bool:
+    return row['collection_status'] != 0
+
+def collected_verizon(row: dict) -> bool:
+    return row['collection_status'] != 400
+
+# How to parse the lookup responses from each ISP, and which 
+# incorporated cities we keep. `name` is how the ISP's files are named.
+PARSERS = {
+    'att': dict(
+        name='att',
+        parse_address=address_att,
+        get_plans=plans_att,
+        is_success=collected,
+        inc_city=inc_city_att
+    ),
+    'cl': dict(
+        name='centurylink',
+        parse_address=address_cl,
+        get_plans=plans_cl,
+        is_success=collected,
+        inc_city=inc_city_cl
+    ),
+    'verizon': dict(
+        name='verizon',
+        parse_address=address_verizon,
+        get_plans=plans_verizon,
+        is_success=collected_verizon,
+        inc_city=inc_city_verizon
+    ),
+    'el': dict(
+        name='earthlink',
+        parse_address=address_el,
+        get_plans=plans_el,
+        is_success=collected,
+        inc_city=inc_city_el
+    ),
+}
+
+def iter_provider(fn: str,
+                  isp: str,
+                  include_offer_meta=False,
+                  batch_size: int = 1000,
+                  include_plans: bool = False,
+                  stats: dict = None,
+                  blocks: tuple = None):
+    """
+    Yields parsed offers from `fn` (or its `blocks`) for the `isp` in `PARSERS`,
+    one batch of addresses at a time.
+    """
+    parser = PARSERS[isp]
+    parse_address = parser['parse_address']
+    if include_offer_meta:
+        parse_address = partial(parse_address, include_offer_meta=True)
+    return iter_offers(fn, 
+                       parser['is_success'],
+                       parse_address,
+                       parser['get_plans'],
+                       batch_size=batch_size, include_plans=include_plans, 
+                       stats=stats, blocks=blocks)
+
+def workflow(fn: str, 
+             isp: str, 
+             include_offer_meta=False, 
+             include_plans: bool = False,
+             stats: dict = None,
+             blocks: tuple = None,
+             sink=None):
+    """
+    Parses every successful lookup in `fn` for the `isp` in `PARSERS`,
+    or only those in a `(start, stop)` range of `blocks` of a block-compressed file.
+    Files that fail to parse are reported and come back empty.
+    If `stats` is given, it's filled with the counts from `count_rows`,
+    and `failures`, which is 1 if `fn` failed to parse.
+    If `sink` is given, each batch is passed to it as soon as it's parsed,
+    rather than combined into one result, and nothing is returned.
+    Batches sent before a failure are the caller's to throw away.
+    """
+    stats = {} if stats is None else stats
+    try:
+        batches = iter_provider(fn, isp, include_offer_meta, 
+                                include_plans=include_plans, 
+                                stats=stats, blocks=blocks)
+        offers = None
+        if sink is None:
+            offers = concat_offers(batches, include_plans)
+        else:
+            for batch in batches:
+                sink(batch)
+        stats['failures'] = 0
+        return offers
+    except Exception as e:
+        print(f"{fn} {e}")
+        # we stopped partway through, so count the rest of the file.
+        stats.clear()
+        try:
+            for _ in count_rows(iter_rows(fn, blocks), PARSERS[isp]['is_success'], stats):
+                pass
+        except Exception:
+            pass
+        stats['failures'] = 1
+        if sink is None:
+            return concat_offers([], include_plans)
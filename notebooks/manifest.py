@@ -0,0 +1,503 @@
+"""
+Incremental re-parsing of lookup responses.
+
+A manifest records the size, mtime, and content hash of every
+block group file we've parsed, and where its parsed offers are saved.
+On a re-run only new or changed files are parsed again, and their
+partitions are spliced in with the rest.
+"""
+import os
+import json
+import time
+import hashlib
+import traceback
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import bgzf
+from executor import Executor, Failure
+from storage import to_table, read_parquets
+
+# what parse workers import when they start, rather than with their first task.
+PARSE_MODULES = ['lookups', 'manifest']
+# block groups smaller than this (compressed) are parsed in batches.
+BATCH_BYTES = 1 << 20
+
+
+def file_hash(fn: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha1 of the contents of `fn`, read in chunks.
+    """
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(fn: str, with_hash: bool = True) -> dict:
+    """
+    The size, mtime and (optionally) content hash of `fn`.
+    """
+    stat = os.stat(fn)
+    record = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+    if with_hash:
+        record['sha1'] = file_hash(fn)
+    return record
+
+def as_list(paths) -> list:
+    """
+    Partitions are a single path, or a list of them for files parsed in parts.
+    """
+    if not paths:
+        return []
+    return [paths] if isinstance(paths, str) else list(paths)
+
+def remove_partitions(entry: dict, keep: dict = None):
+    """
+    Deletes the partitions of `entry`, except for any still used by `keep`.
+    """
+    keep = keep or {}
+    for key in ['partition', 'plans']:
+        for fn in set(as_list(entry.get(key))) - set(as_list(keep.get(key))):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+class Manifest:
+    """
+    Maps each input file to its fingerprint and parsed partition,
+    saved as JSON at `fn`.
+    """
+    def __init__(self, fn: str):
+        self.fn = fn
+        self.entries = {}
+        if os.path.exists(fn):
+            with open(fn, 'r') as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.fn)), exist_ok=True)
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.fn)
+
+    def clear(self):
+        self.entries = {}
+
+    def is_current(self, fn: str) -> bool:
+        """
+        Whether `fn` was parsed and hasn't changed since.
+        Size and mtime are checked first, and the file is only hashed
+        if they differ, which catches files that were touched but not changed.
+        """
+        entry = self.entries.get(fn)
+        if not entry or not entry.get('partition'):
+            return False
+        if not all(os.path.exists(p) for p in as_list(entry['partition'])):
+            return False
+        stat = os.stat(fn)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        if file_hash(fn) == entry['sha1']:
+            entry['mtime'] = stat.st_mtime
+            return True
+        return False
+
+    def stale(self, files: list) -> list:
+        """
+        Files in `files` that are new or changed.
+        """
+        return [fn for fn in files if not self.is_current(fn)]
+
+    def removed(self, files: list) -> list:
+        """
+        Files in the manifest that are no longer in `files`.
+        """
+        files = set(files)
+        return [fn for fn in self.entries if fn not in files]
+
+    def update(self, fn: str, record: dict):
+        if fn in self.entries:
+            remove_partitions(self.entries[fn], keep=record)
+        self.entries[fn] = record
+
+
+def partition_path(fn: str, partition_dir: str, suffix: str = '.parquet') -> str:
+    """
+    Where the parsed offers of `fn` are saved,
+    e.g. `{partition_dir}/kansas city/291650303054.parquet`.
+    """
+    city = os.path.basename(os.path.dirname(fn))
+    name = os.path.basename(fn).split('.geojson')[0]
+    return os.path.join(partition_dir, city, name + suffix)
+
+def write_partition(df: pd.DataFrame, fn: str):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    pq.write_table(to_table(df), fn)
+
+
+class PartitionWriter:
+    """
+    Writes the batches of one parse to Parquet as they're parsed, one row group
+    each, so a worker only ever holds one batch. A file's row groups share one
+    schema, so a batch with columns the file doesn't have starts a new file
+    (`{name}-1.parquet`, and so on); columns a batch is missing are null.
+    Files are written under temporary names, and only moved into place by
+    `close`, so a parse that fails partway can be thrown away with `discard`.
+    """
+    def __init__(self, fn: str):
+        self.fn = fn
+        self.fns = []
+        self.n_rows = 0
+        self._writer = None
+        self._schema = None
+
+    def path(self, i: int) -> str:
+        stem = self.fn[:-len('.parquet')]
+        return self.fn if i == 0 else f"{stem}-{i}.parquet"
+
+    def write(self, df: pd.DataFrame):
+        if df is None or not len(df):
+            return
+        table = to_table(df)
+        if self._writer is not None and not set(table.column_names) <= set(self._schema.names):
+            self._writer.close()
+            self._writer = None
+        if self._writer is None:
+            fn = self.path(len(self.fns))
+            self.fns.append(fn)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(fn + '.tmp', self._schema)
+        columns = [table.column(field.name) if field.name in table.column_names
+                   else pa.nulls(table.num_rows, field.type)
+                   for field in self._schema]
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self._schema))
+        self.n_rows += table.num_rows
+
+    def close(self):
+        """
+        Moves the files into place, and returns their paths for the manifest:
+        one path, or a list of them. Without any rows, an empty file is written.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if not self.fns:
+            self.fns.append(self.fn)
+            write_partition(pd.DataFrame(), self.fn + '.tmp')
+        for fn in self.fns:
+            os.replace(fn + '.tmp', fn)
+        return self.fns[0] if len(self.fns) == 1 else self.fns
+
+    def discard(self):
+        """
+        Throws away everything written so far.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for fn in self.fns:
+            if os.path.exists(fn + '.tmp'):
+                os.remove(fn + '.tmp')
+        self.fns = []
+        self.n_rows = 0
+
+
+def parse_to_partition(fn: str,
+                       workflow,
+                       partition_dir: str,
+                       include_plans: bool = False,
+                       blocks: tuple = None,
+                       part: int = None) -> tuple:
+    """
+    Parses `fn` with `workflow` (`lookups.workflow` for one ISP), writes each
+    batch to its partition as it's parsed, and returns the manifest entry
+    for `fn`, with the row counts `workflow` kept in `stats`.
+    If `part` is given, only the `blocks` of a block-compressed file are parsed,
+    and the entry is for that part alone (see `merge_parts`).
+    """
+    stats = {}
+    kwargs = {}
+    if part is None:
+        record = fingerprint(fn)
+        suffix = ''
+    else:
+        record = {'part': part}
+        suffix = f'.{part}'
+        kwargs['blocks'] = blocks
+    offers = PartitionWriter(partition_path(fn, partition_dir, suffix + '.parquet'))
+    plans = PartitionWriter(partition_path(fn, partition_dir, suffix + '.plans.parquet'))
+
+    def sink(batch):
+        if include_plans:
+            batch, _plans = batch
+            plans.write(_plans)
+        offers.write(batch)
+
+    workflow(fn, include_plans=include_plans, stats=stats, sink=sink, **kwargs)
+    if stats.get('failures'):
+        # like `workflow` without a sink, a file that fails comes back empty.
+        offers.discard()
+        plans.discard()
+    record['stats'] = stats
+    if include_plans:
+        record['plans'] = plans.close()
+    record['partition'] = offers.close()
+    record['n_records'] = offers.n_rows
+    return fn, record
+
+def merge_parts(fn: str, parts: list) -> dict:
+    """
+    Combines the entries of each part of `fn` into one manifest entry.
+    """
+    parts = sorted(parts, key=lambda record: record['part'])
+    record = fingerprint(fn)
+    record['partition'] = [p for part in parts for p in as_list(part['partition'])]
+    if all(part.get('plans') for part in parts):
+        record['plans'] = [p for part in parts for p in as_list(part['plans'])]
+    record['stats'] = {}
+    for part in parts:
+        for key, n in part['stats'].items():
+            record['stats'][key] = record['stats'].get(key, 0) + n
+    record['n_records'] = sum(part['n_records'] for part in parts)
+    return record
+
+def prune(manifest: Manifest, files: list):
+    """
+    Drops files that are no longer in `files` from `manifest`,
+    along with their partitions.
+    """
+    for fn in manifest.removed(files):
+        remove_partitions(manifest.entries.pop(fn))
+
+def to_parse(manifest: Manifest, files: list, include_plans: bool = False) -> list:
+    """
+    Files in `files` that need to be parsed, including ones that were
+    parsed without their row counts, or their plan tables if `include_plans`.
+    """
+    stale = manifest.stale(files)
+    _stale = set(stale)
+    for fn in files:
+        if fn in _stale:
+            continue
+        entry = manifest.entries[fn]
+        if 'stats' not in entry or (include_plans and not entry.get('plans')):
+            stale.append(fn)
+    return stale
+
+def make_tasks(files: list,
+               workflow,
+               partition_dir: str,
+               include_plans: bool = False,
+               max_blocks: int = None) -> list:
+    """
+    Arguments to `parse_to_partition` for each of `files`.
+    Block-compressed files with more than `max_blocks` blocks are split into
+    parts, so one big file can be parsed by several workers.
+    """
+    tasks = []
+    for fn in files:
+        if max_blocks and bgzf.has_index(fn):
+            ranges = bgzf.split(fn, max_blocks)
+            if len(ranges) > 1:
+                tasks.extend((fn, workflow, partition_dir, include_plans, blocks, part)
+                             for part, blocks in enumerate(ranges))
+                continue
+        tasks.append((fn, workflow, partition_dir, include_plans))
+    return tasks
+
+## Scheduling
+def task_bytes(tasks: list) -> list:
+    """
+    The compressed size of what each of `tasks` parses: its file, or its part's blocks.
+    """
+    sizes = []
+    blocks = {}
+    for task in tasks:
+        fn = task[0]
+        if len(task) > 4:
+            if fn not in blocks:
+                blocks[fn] = bgzf.read_index(fn)['blocks']
+            start, stop = task[4]
+            sizes.append(sum(block[1] for block in blocks[fn][start:stop]))
+        else:
+            sizes.append(os.path.getsize(fn))
+    return sizes
+
+def schedule(tasks: list, batch_bytes: int = BATCH_BYTES) -> list:
+    """
+    `tasks` in batches, biggest first (longest-processing-time-first), so the
+    biggest block groups don't start last and hold up the end of a run.
+    Tasks smaller than `batch_bytes` are batched together, up to about that
+    many bytes, so small block groups don't cost a round trip each.
+    """
+    sizes = task_bytes(tasks)
+    batches = []
+    batch = []
+    size = 0
+    for i in sorted(range(len(tasks)), key=lambda i: -sizes[i]):
+        if sizes[i] >= batch_bytes:
+            batches.append([tasks[i]])
+            continue
+        batch.append(tasks[i])
+        size += sizes[i]
+        if size >= batch_bytes:
+            batches.append(batch)
+            batch = []
+            size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parse_batch(batch: list) -> tuple:
+    """
+    `parse_to_partition` for each tuple of its arguments in `batch`.
+    Returns what each returned (or a `Failure`, if it raised),
+    and which worker parsed the batch, from when to when.
+    """
+    start = time.time()
+    results = []
+    for task in batch:
+        try:
+            results.append(parse_to_partition(*task))
+        except Exception as e:
+            failure = Failure(None, repr(e), traceback.format_exc())
+            failure.task = task
+            results.append(failure)
+    timing = {'pid': os.getpid(), 'start': start, 'stop': time.time(), 'tasks': len(batch)}
+    return results, timing
+
+def utilization(timings: list, start: float, stop: float) -> pd.DataFrame:
+    """
+    For each worker, how many tasks it parsed, how long it was busy,
+    what share of the run (from `start` to `stop`) that was,
+    and how long it sat idle at the end, waiting on the others.
+    """
+    timings = pd.DataFrame(timings, columns=['pid', 'start', 'stop', 'tasks'])
+    timings['busy'] = timings['stop'] - timings['start']
+    workers = timings.groupby('pid').agg(tasks=('tasks', 'sum'), busy=('busy', 'sum'), last=('stop', 'max'))
+    workers['utilization'] = workers['busy'] / (stop - start)
+    workers['idle_at_end'] = stop - workers.pop('last')
+    return workers
+
+def run_tasks(executor,
+              tasks: list, 
+              get_manifest, 
+              save_every: int = 500,
+              batch_bytes: int = BATCH_BYTES) -> pd.DataFrame:
+    """
+    Runs `tasks` from `make_tasks` on `executor`, in batches from `schedule`,
+    and records each file in the manifest `get_manifest(fn)` returns once all
+    of its parts are parsed. Files that fail to parse aren't recorded, so
+    they're parsed again next time. Returns the `utilization` of each worker.
+    """
+    n_parts = {}
+    for task in tasks:
+        n_parts[task[0]] = n_parts.get(task[0], 0) + 1
+    manifests = {}
+    parts = {}
+    failed = set()
+    timings = []
+    n_done = 0
+    start = time.time()
+    # batches are sent one at a time, in order, so the biggest start first.
+    batches = executor.map(parse_batch, schedule(tasks, batch_bytes), ordered=False, chunksize=1)
+    for batch in batches:
+        if isinstance(batch, Failure):
+            results = []
+            for task in batch.task:
+                failure = Failure(None, batch.error, batch.traceback)
+                failure.task = task
+                results.append(failure)
+        else:
+            results, timing = batch
+            timings.append(timing)
+        for result in results:
+            if isinstance(result, Failure):
+                fn = result.task[0]
+                print(f"failed to parse {fn}: {result.error}")
+                failed.add(fn)
+                parts.pop(fn, None)
+                continue
+            fn, record = result
+            if fn in failed:
+                continue
+            manifest = manifests.setdefault(fn, get_manifest(fn))
+            if 'part' in record:
+                parts.setdefault(fn, []).append(record)
+                if len(parts[fn]) < n_parts[fn]:
+                    continue
+                record = merge_parts(fn, parts.pop(fn))
+            manifest.update(fn, record)
+            n_done += 1
+            if n_done % save_every == 0:
+                manifest.save()
+    stop = time.time()
+
+    workers = utilization(timings, start, stop)
+    if len(workers):
+        print(f"{len(workers)} workers were busy {workers.utilization.mean():.0%} of {stop - start:.0f}s; "
+              f"the first finished {workers.idle_at_end.max():.0f}s before the last")
+    return workers
+
+def summarize(manifest: Manifest, files: list) -> dict:
+    """
+    Adds up the row counts of all parsed `files`.
+    """
+    totals = {'files': 0}
+    for fn in files:
+        entry = manifest.entries.get(fn)
+        if not entry:
+            continue
+        totals['files'] += 1
+        for key, n in entry.get('stats', {}).items():
+            totals[key] = totals.get(key, 0) + n
+    return totals
+
+def collect(manifest: Manifest, files: list, include_plans: bool = False):
+    """
+    The parsed offers for all `files` (and plan tables, if `include_plans`).
+    Files that failed to parse, so aren't in the manifest, are reported and left out.
+    """
+    missing = [fn for fn in files if fn not in manifest.entries]
+    if missing:
+        print(f"{len(missing)} files failed to parse and are left out, e.g. {missing[0]}")
+        files = [fn for fn in files if fn in manifest.entries]
+    offers = read_parquets([p for fn in files 
+                              for p in as_list(manifest.entries[fn]['partition'])])
+    if not include_plans:
+        return offers
+    plans = read_parquets([p for fn in files 
+                             for p in as_list(manifest.entries[fn]['plans'])])
+    return offers, plans
+
+def parse_incremental(files: list,
+                      workflow,
+                      manifest: Manifest,
+                      partition_dir: str,
+                      n_jobs: int = 20,
+                      include_plans: bool = False,
+                      save_every: int = 500,
+                      max_blocks: int = None,
+                      batch_bytes: int = BATCH_BYTES):
+    """
+    Parses the files in `files` that are new or changed since the last run,
+    and returns the parsed offers for all `files` (and plan tables, if `include_plans`).
+    """
+    prune(manifest, files)
+    stale = to_parse(manifest, files, include_plans)
+    if stale:
+        tasks = make_tasks(stale, workflow, partition_dir, include_plans, max_blocks)
+        with Executor(n_jobs, preload=PARSE_MODULES) as executor:
+            run_tasks(executor, tasks, lambda fn: manifest, save_every, batch_bytes)
+    manifest.save()
+    return collect(manifest, files, include_plans)
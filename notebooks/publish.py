@@ -0,0 +1,148 @@
+"""
+Publishes offers as one CSV per ISP and city, like `data/output/by_city/`.
+
+Cities are written in parallel on an `executor.Executor`, which shares the
+offers with its workers once, and `manifest.json` records the row count,
+size and sha1 of each file. Rows are sorted by block group within each file,
+and the manifest also records the byte range of each block group, so a
+city or block group can be read without scanning anything else.
+`block_groups.json` maps each block group to the files (and ranges) it's in.
+"""
+import io
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from aggregators import bucket_and_bin
+from executor import Executor, Failure
+
+
+def partition_name(city: str, isp: str) -> str:
+    return f'{city}_{isp.lower()}_plans.csv'
+
+def block_group_keys(block_groups: pd.Series) -> pd.Series:
+    """
+    Block groups as they're written to CSV: whole numbers without a decimal point.
+    """
+    if pd.api.types.is_float_dtype(block_groups):
+        block_groups = block_groups.astype('Int64')
+    return block_groups.astype(str)
+
+def block_group_ranges(data: bytes, keys: pd.Series) -> dict:
+    """
+    The `[offset, length]` in bytes of each block group's rows in the CSV `data`,
+    whose rows are sorted by `keys`. Empty if a field spans lines.
+    """
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+    if len(newlines) != len(keys) + 1:
+        return {}
+    # row i is the bytes after newline i, up to and including newline i + 1.
+    keys = keys.values
+    firsts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    stops = np.r_[firsts[1:], len(keys)]
+    return {
+        keys[first]: [int(newlines[first] + 1), int(newlines[stop] - newlines[first])]
+        for first, stop in zip(firsts, stops)
+    }
+
+def write_partition(df: pd.DataFrame, rows: np.ndarray, fn: str, columns: list, isp: str) -> dict:
+    """
+    Bins the offers of one city (`rows` of `df`), writes them to CSV, and returns its manifest entry.
+    """
+    df = bucket_and_bin(df.iloc[rows].copy())
+    keys = block_group_keys(df['block_group'])
+    order = np.argsort(keys.values, kind='stable')
+    df = df.iloc[order]
+    keys = keys.iloc[order]
+    data = df[columns or list(df.columns)].to_csv(index=False).encode('utf-8')
+    with open(fn + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(fn + '.tmp', fn)
+    return {
+        'isp': isp,
+        'major_city': df['major_city'].iloc[0],
+        'rows': len(df),
+        'bytes': len(data),
+        'sha1': hashlib.sha1(data).hexdigest(),
+        'header_bytes': data.index(b'\n') + 1,
+        'block_groups': block_group_ranges(data, keys),
+    }
+
+def read_manifest(out_dir: str) -> dict:
+    fn = os.path.join(out_dir, 'manifest.json')
+    if not os.path.exists(fn):
+        return {}
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+def write_manifest(manifest: dict, out_dir: str):
+    """
+    Saves `manifest`, and the index of block groups derived from it.
+    """
+    index = {}
+    for name, entry in sorted(manifest.items()):
+        for block_group, (offset, length) in entry['block_groups'].items():
+            index.setdefault(block_group, []).append([name, offset, length])
+    for fn, obj in [('manifest.json', manifest), ('block_groups.json', index)]:
+        fn = os.path.join(out_dir, fn)
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(obj, f, indent=1, sort_keys=True)
+        os.replace(fn + '.tmp', fn)
+
+def publish(df: pd.DataFrame,
+            isp: str,
+            out_dir: str,
+            columns: list = None,
+            n_jobs: int = None) -> dict:
+    """
+    Writes the offers of `isp` in `df` to one CSV per city in `out_dir`, across
+    `n_jobs` processes (all cores, by default) that share `df`, rather than
+    each getting a copy of its city. Each city is binned by `bucket_and_bin`
+    on its own, and only `columns` are written. Files of `isp` for cities
+    no longer in `df` are removed.
+    Returns the manifest entries of the files that were written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with Executor(n_jobs, preload=['publish']) as executor:
+        shared = executor.share(df)
+        tasks = [(shared, rows, os.path.join(out_dir, partition_name(city, isp)), columns, isp)
+                 for city, rows in df.groupby('major_city').indices.items()]
+        entries = list(executor.map(write_partition, tasks, star=True, desc=isp))
+    failures = [entry for entry in entries if isinstance(entry, Failure)]
+    if failures:
+        raise RuntimeError(f"couldn't write {failures[0].task[2]}:\n{failures[0].traceback}")
+    written = {os.path.basename(task[2]): entry for task, entry in zip(tasks, entries)}
+
+    manifest = read_manifest(out_dir)
+    for name in [name for name, entry in manifest.items() if entry['isp'] == isp]:
+        if name not in written and os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+        manifest.pop(name)
+    manifest.update(written)
+    write_manifest(manifest, out_dir)
+    return written
+
+## Reading
+def read_range(fn: str, offset: int, length: int, header_bytes: int) -> pd.DataFrame:
+    with open(fn, 'rb') as f:
+        header = f.read(header_bytes)
+        f.seek(offset)
+        return pd.read_csv(io.BytesIO(header + f.read(length)))
+
+def read_city(out_dir: str, city: str, isp: str) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(out_dir, partition_name(city, isp)))
+
+def read_block_group(out_dir: str, block_group) -> pd.DataFrame:
+    """
+    The offers in `block_group` from every ISP, reading only its rows of each file.
+    """
+    with open(os.path.join(out_dir, 'block_groups.json'), 'r') as f:
+        ranges = json.load(f).get(str(block_group), [])
+    manifest = read_manifest(out_dir)
+    frames = [read_range(os.path.join(out_dir, name), offset, length,
+                         manifest[name]['header_bytes'])
+              for name, offset, length in ranges]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
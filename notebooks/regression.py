@@ -0,0 +1,189 @@
+"""
+Logistic regressions of being offered slow speeds on income, race and redlining, by city.
+
+Each city's design matrix is built once, with the dummies of every IV and
+every control, named like patsy names them in `smf.logit`. Every model
+(`{iv}_alone`, `{iv}_controls` and `{iv}_minus_{control}`) is fit on a
+subset of its columns, and of the rows that aren't missing any of them.
+Models with controls are fit first, and the rest start from their coefficients.
+"""
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+# the reference level of each IV
+IV2TREATMENT = {
+    "income_level" : 'Upper Income',
+    "race_quantile" : 'most white',
+    "redlining_grade" : 'rest'
+}
+GRADE2REST = {
+    'A' : 'rest',
+    'B' : 'rest',
+}
+CONTROLS = ['ppl_per_sq_mile_standard', 'n_providers', 'internet_perc_broadband']
+# not enough variance in competition in these cities' redlined areas.
+NO_PROVIDERS = {'redlining_grade': ['Omaha', 'Phoenix']}
+SLOW = "Slow (<25 Mbps)"
+
+
+def standardize(df: pd.DataFrame, columns: list, by: list) -> pd.DataFrame:
+    """
+    `columns` of `df` scaled to zero mean and unit variance within each group `by`,
+    like fitting a `StandardScaler` on each group. Nulls are ignored, and stay null.
+    """
+    keys = [df[col] for col in by]
+    deviation = df[columns] - df[columns].groupby(keys).transform('mean')
+    # population standard deviation, like StandardScaler
+    std = np.sqrt((deviation ** 2).groupby(keys).transform('mean'))
+    return deviation / std.where(std > 0, 1)
+
+def preprocess_for_log_reg(df: pd.DataFrame, by: tuple = ('major_city', 'state')) -> pd.DataFrame:
+    """
+    Controls for the regressions, standardized within each city.
+    """
+    df['n_providers'] = df['n_providers'] - 1
+    df['income_dollars_below_median'] = df['income_dollars_below_median'] / 100
+    df['constant'] = 1
+
+    # if there are no competitors, make this variable null.
+    # Then this variable is linked to the outcome.
+    df.loc[df.n_providers < 1, 'internet_perc_broadband'] = None
+
+    standard = standardize(df, ['lat', 'lon', 'ppl_per_sq_mile'], by)
+    for col in standard.columns:
+        df[f'{col}_standard'] = standard[col]
+    df[['income_dollars_below_median', 'internet_perc_broadband']] = standardize(
+        df, ['income_dollars_below_median', 'internet_perc_broadband'], by
+    )
+    # income_level and race_quantile are never graded.
+    df['redlining_grade'] = df['redlining_grade'].replace(GRADE2REST)
+    return df
+
+## Models
+def model_specs(df: pd.DataFrame, city: str, isp: str) -> list:
+    """
+    The `(model, iv, controls)` of every model worth fitting in `df`, one city's offers.
+    """
+    n_slow = (df.speed_down_bins == SLOW).sum()
+    n_all = len(df)
+    if (df.speed_down_bins.nunique() <= 1) or (n_slow / n_all <= .01) or ((n_all - n_slow) / n_all <= .01):
+        # not enough speed
+        return []
+    specs = []
+    for iv in IV2TREATMENT:
+        if iv == 'race_quantile':
+            n_minority_white = (df.race_perc_non_white > .5).sum()
+            n_majority_white = (df.race_perc_non_white < .5).sum()
+            # check only cities with at least 5 percent of addresses in minority white.
+            if n_minority_white / n_all <= .05 or n_majority_white / n_all <= .05:
+                print(f"skip {city} {isp} race")
+                continue
+        elif iv == 'redlining_grade':
+            if df.redlining_grade.notnull().sum() <= n_all * .05:
+                print(f"skip {city} {isp} redline")
+                continue
+            if 'D' not in df['redlining_grade'].unique().tolist():
+                print(f"skip {city} {isp} redline")
+                continue
+
+        controls = [c for c in CONTROLS
+                    if not (c == 'n_providers' and city in NO_PROVIDERS.get(iv, []))]
+        specs.append((f"{iv}_alone", iv, []))
+        specs.append((f"{iv}_controls", iv, controls))
+        # ablations
+        for control in controls:
+            specs.append((f"{iv}_minus_{control}", iv, [c for c in controls if c != control]))
+    return specs
+
+def levels(series: pd.Series) -> list:
+    """
+    The levels of `series`, in the order patsy codes them.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return list(series.cat.categories)
+    return sorted(series.dropna().unique().tolist())
+
+def design_matrix(df: pd.DataFrame, ivs: dict = IV2TREATMENT, controls: list = CONTROLS) -> tuple:
+    """
+    An intercept, the treatment-coded dummies of each of `ivs`, and `controls`.
+    Returns the matrix, its column names, the columns of each term,
+    and the rows each term is missing.
+    """
+    blocks = [np.ones((len(df), 1))]
+    columns = ['Intercept']
+    terms = {'Intercept': [0]}
+    missing = {'Intercept': np.zeros(len(df), dtype=bool)}
+    for iv, treatment in ivs.items():
+        _levels = levels(df[iv])
+        if treatment not in _levels:
+            continue
+        codes = pd.Categorical(df[iv], categories=_levels).codes
+        contrasts = [i for i, level in enumerate(_levels) if level != treatment]
+        blocks.append((codes[:, None] == np.array(contrasts)[None, :]).astype(float))
+        terms[iv] = list(range(len(columns), len(columns) + len(contrasts)))
+        columns += [f"C({iv}, Treatment('{treatment}'))[T.{_levels[i]}]" for i in contrasts]
+        missing[iv] = codes == -1
+    for col in controls:
+        values = df[col].values.astype(float)
+        blocks.append(values[:, None])
+        terms[col] = [len(columns)]
+        columns.append(col)
+        missing[col] = np.isnan(values)
+    return np.hstack(blocks), columns, terms, missing
+
+def fit_logit(y: np.ndarray, X: np.ndarray, start_params: np.ndarray = None):
+    """
+    A logit of `y` on `X` started from `start_params`, or from scratch
+    if it doesn't converge from there. Also returns its pseudo R-squared.
+    """
+    model = sm.Logit(y, X)
+    results = None
+    if start_params is not None:
+        try:
+            results = model.fit(start_params=start_params, disp=0)
+        except Exception:
+            pass
+    if results is None or not results.mle_retvals['converged']:
+        results = model.fit(disp=0)
+    # the likelihood of an intercept alone, without fitting one.
+    p = y.mean()
+    llnull = len(y) * (p * np.log(p) + (1 - p) * np.log(1 - p))
+    return results, 1 - results.llf / llnull
+
+def fit_city(df: pd.DataFrame, city: str, isp: str, specs: list) -> pd.DataFrame:
+    """
+    Fits every model in `specs` (from `model_specs`) on `df`, one city's offers.
+    Returns the coefficients of each model, or the error it raised.
+    """
+    if not specs:
+        return pd.DataFrame([])
+    X, columns, terms, missing = design_matrix(df)
+    y = df['is_slow'].values.astype(float)
+    meta = {'N': len(df), 'major_city': city, 'state': df.state.iloc[0], 'isp': isp}
+    fitted = {}
+    coefs = {}
+    # models with controls first, to start the others from
+    for model, iv, controls in sorted(specs, key=lambda spec: not spec[0].endswith('_controls')):
+        try:
+            used = ['Intercept', iv] + controls
+            cols = [i for term in used for i in terms[term]]
+            rows = ~np.logical_or.reduce([missing[term] for term in used])
+            start_params = None
+            if f"{iv}_controls" in fitted:
+                start_params = np.array([fitted[f"{iv}_controls"].get(i, 0.) for i in cols])
+            results, pr_sq = fit_logit(y[rows], X[np.ix_(rows, cols)], start_params)
+            params = results.params
+            fitted[model] = dict(zip(cols, params))
+            coefs[model] = pd.DataFrame({
+                'coef': params,
+                'odds_ratio': np.exp(params),
+                'pvalue': results.pvalues,
+                'pr_sq': pr_sq,
+                **meta,
+                'model' : model,
+                'intercept': params[0],
+            }, index=[columns[i] for i in cols])
+        except Exception as e:
+            coefs[model] = pd.DataFrame([{**meta, 'model' : model, 'error': e}])
+    return pd.concat([coefs[model] for model, _, _ in specs])
@@ -0,0 +1,239 @@
+"""
+Renders the report charts of every ISP and city to files, outside of Jupyter.
+
+Charts are drawn from the count cubes of `aggregators.build_cube`, on the
+Agg backend, across an `executor.Executor` with one task per ISP, city and
+chart. Each figure is saved next to a CSV of the numbers behind it, and charts
+whose counts haven't changed since the last run are skipped. A chart that
+fails is reported and drawn again next time, without stopping the rest.
+
+Usage:
+    python render.py                    # every ISP
+    python render.py att verizon --n-jobs 8 --fmt svg
+"""
+import os
+import json
+import hashlib
+import argparse
+import contextlib
+
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from config import DATA_DIR, CHART_DIR, isp2name, isp2price
+from executor import Executor, Failure
+from lookups import PARSERS
+from aggregators import (
+    filter_df,
+    build_cube,
+    get_counts,
+    speed_matrix,
+    speed_shares,
+    unserved_shares,
+    unserved,
+    speed_breakdown,
+    plot_race,
+    race,
+    income,
+    redlining
+)
+
+# each chart's plotter, and the dimension of the cube it's drawn from.
+CHARTS = {
+    'unserved': dict(plot=unserved, dimension='unserved'),
+    'speed_breakdown': dict(plot=speed_breakdown, dimension='all'),
+    'plot_race': dict(plot=plot_race, dimension='race_perc'),
+    'race': dict(plot=race, dimension='race_quantile'),
+    'income': dict(plot=income, dimension='income_level'),
+    'redlining': dict(plot=redlining, dimension='redlining_grade'),
+}
+# charts that compare cities, so they're only drawn nationally.
+NATIONAL_CHARTS = ['unserved']
+
+
+def slug(name: str) -> str:
+    return name.lower().replace('&', '').replace(' ', '_')
+
+def chart_path(out_dir: str, isp: str, city: str, chart: str, fmt: str = 'png') -> str:
+    """
+    e.g. `{out_dir}/att/kansas_city/race.png`, or `{out_dir}/att/national/race.png`.
+    """
+    return os.path.join(out_dir, slug(isp), slug(city or 'national'), f"{chart}.{fmt}")
+
+def data_path(fn: str) -> str:
+    return os.path.splitext(fn)[0] + '.csv'
+
+def chart_data(cube: pd.DataFrame, chart: str, isp: str = None, city: str = None) -> pd.DataFrame:
+    """
+    The numbers behind `chart`: the percentage of households in each
+    speed bin by level, and how many households there are (`N`).
+    """
+    if chart == 'unserved':
+        return (unserved_shares(cube, isp) * 100).sort_values().to_frame('unserved')
+    dimension = CHARTS[chart]['dimension']
+    matrix = speed_matrix(get_counts(cube, dimension, isp, city))
+    matrix = matrix.drop(index=['', 'E'] if chart == 'redlining' else [''], errors='ignore')
+    data = (speed_shares(matrix) * 100).rename_axis(index=dimension, columns=None)
+    data['N'] = matrix.sum(axis=1)
+    return data
+
+def chart_kwargs(chart: str, isp: str, city: str = None) -> dict:
+    kwargs = dict(isp=isp)
+    if chart not in NATIONAL_CHARTS:
+        kwargs['city'] = city
+        kwargs['location'] = city.title() if city else 'National'
+    if chart == 'plot_race':
+        kwargs['price'] = isp2price.get(isp, '$55')
+    return kwargs
+
+def task_key(counts: pd.DataFrame, chart: str, kwargs: dict, fmt: str) -> str:
+    """
+    A hash of everything a chart is drawn from, to tell when it needs redrawing.
+    """
+    h = hashlib.sha1(pd.util.hash_pandas_object(counts, index=False).values.tobytes())
+    h.update(json.dumps([chart, kwargs, fmt], sort_keys=True).encode())
+    return h.hexdigest()
+
+def make_tasks(cube: pd.DataFrame,
+               out_dir: str = CHART_DIR,
+               charts: list = None,
+               fmt: str = 'png') -> list:
+    """
+    A task for each chart of each ISP in `cube`, nationally and in each city,
+    with just the counts it's drawn from.
+    """
+    charts = charts or list(CHARTS)
+    tasks = []
+    for isp in cube.isp.unique():
+        isp_cube = cube[cube.isp == isp]
+        national = isp_cube[isp_cube.binning != 'city']
+        slices = [(None, national)] + list(isp_cube.groupby('major_city', observed=True))
+        for city, counts in slices:
+            for chart in charts:
+                if city and chart in NATIONAL_CHARTS:
+                    continue
+                if chart == 'unserved' and not unserved_shares(counts, isp).any():
+                    # offers from `filter_df` are all served.
+                    continue
+                kwargs = chart_kwargs(chart, isp, city)
+                tasks.append(dict(
+                    chart=chart,
+                    counts=counts,
+                    kwargs=kwargs,
+                    fn=chart_path(out_dir, isp, city, chart, fmt),
+                    key=task_key(counts, chart, kwargs, fmt),
+                ))
+    return tasks
+
+@contextlib.contextmanager
+def agg_backend():
+    """
+    Draws on the Agg backend, where the plotters' `plt.show()` neither blocks
+    nor closes the figure (as Jupyter's inline backend does), then switches back.
+    """
+    backend = plt.get_backend()
+    plt.switch_backend('Agg')
+    try:
+        yield
+    finally:
+        plt.switch_backend(backend)
+
+def render_chart(task: dict) -> tuple:
+    """
+    Draws one chart to `task['fn']`, and saves the numbers behind it next to it.
+    """
+    os.makedirs(os.path.dirname(task['fn']), exist_ok=True)
+    kwargs = task['kwargs']
+    data = chart_data(task['counts'], task['chart'], kwargs['isp'], kwargs.get('city'))
+    with agg_backend():
+        plt.close('all')
+        try:
+            CHARTS[task['chart']]['plot'](task['counts'], **kwargs)
+            fig = plt.gcf()
+            if fig.axes:
+                fig.savefig(task['fn'], bbox_inches='tight', dpi=150)
+            elif not (task['chart'] == 'redlining' and data['N'].sum() == 0):
+                # only `redlining` draws nothing, in cities without HOLC maps.
+                raise RuntimeError(f"{task['chart']} drew no figure")
+        finally:
+            plt.close('all')
+    data.to_csv(data_path(task['fn']))
+    return task['fn'], task['key']
+
+def render(cube: pd.DataFrame,
+           out_dir: str = CHART_DIR,
+           charts: list = None,
+           n_jobs: int = None,
+           fmt: str = 'png',
+           recalculate: bool = False) -> tuple:
+    """
+    Renders every chart of `cube` (one or more ISPs, from `build_cube`)
+    to `out_dir` across `n_jobs` processes, except those drawn from the same
+    counts last time. `index.json` in `out_dir` records what each was drawn from.
+    Returns the paths of the charts that were rendered, and the error of each
+    chart that failed, by path. Failed charts are left out of the index.
+    """
+    fn_index = os.path.join(out_dir, 'index.json')
+    index = {}
+    if os.path.exists(fn_index) and not recalculate:
+        with open(fn_index, 'r') as f:
+            index = json.load(f)
+    tasks = [task for task in make_tasks(cube, out_dir, charts, fmt)
+             if index.get(task['fn']) != task['key'] or not os.path.exists(data_path(task['fn']))]
+    rendered = []
+    failed = {}
+    if tasks:
+        with Executor(n_jobs, preload=['render']) as executor:
+            for result in executor.map(render_chart, tasks, ordered=False):
+                if isinstance(result, Failure):
+                    fn = result.task['fn']
+                    print(f"failed to render {fn}: {result.error}")
+                    failed[fn] = result.error
+                    index.pop(fn, None)
+                    continue
+                fn, key = result
+                index[fn] = key
+                rendered.append(fn)
+        os.makedirs(out_dir, exist_ok=True)
+        with open(fn_index, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+    return rendered, failed
+
+def load_cube(isp: str, data_dir: str = DATA_DIR) -> pd.DataFrame:
+    """
+    The cube of `isp` (e.g. "att"), from the offers `filter_df` keeps.
+    """
+    dir_offers = os.path.join(data_dir, 'output/speed_price')
+    fn = dir_offers if os.path.exists(dir_offers) else \
+        os.path.join(data_dir, f"output/speed_price_{PARSERS[isp]['name']}.csv.gz")
+    return build_cube(filter_df(fn, isp2name[isp]), isp2name[isp])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('isps', nargs='*', metavar='isp',
+                        help=f"ISPs to render: {', '.join(isp2name)} (default: all of them)")
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--out-dir', default=CHART_DIR)
+    parser.add_argument('--charts', nargs='+', choices=list(CHARTS), default=None)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--fmt', default='png', help='figure format, e.g. png, svg or pdf')
+    parser.add_argument('--recalculate', action='store_true',
+                        help='render every chart, not only the ones whose counts changed')
+    args = parser.parse_args()
+    for isp in args.isps:
+        if isp not in isp2name:
+            parser.error(f"unknown ISP {isp!r}, choose from {', '.join(isp2name)}")
+
+    cube = pd.concat([load_cube(isp, args.data_dir) for isp in args.isps or isp2name],
+                     ignore_index=True)
+    rendered, failed = render(cube,
+                              out_dir=args.out_dir,
+                              charts=args.charts,
+                              n_jobs=args.n_jobs,
+                              fmt=args.fmt,
+                              recalculate=args.recalculate)
+    print(f"rendered {len(rendered)} charts in {args.out_dir}, {len(failed)} failed")
+
+if __name__ == '__main__':
+    main()
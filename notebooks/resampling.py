@@ -0,0 +1,124 @@
+"""
+Bootstrap confidence intervals and permutation p-values for the disparities
+in `table1_disparities_by_city`.
+
+`is_slow` is binary, so resampling a group's households with replacement
+is the same as drawing how many of them are slow from a binomial, and
+shuffling households between the exposure and treatment groups is the same
+as drawing how many slow ones land in the exposure group from a hypergeometric.
+So every replicate of a city is drawn from its counts in `disparity_counts`,
+and thousands of them are a few vectorized draws, however many households it has.
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from disparity import IVS
+from executor import Executor, Failure
+
+
+def city_rng(seed: int, *key) -> np.random.Generator:
+    """
+    A generator seeded by `seed` and `key` (e.g. ISP, city and IV), so a city's
+    replicates don't depend on which other cities are resampled, or where.
+    """
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return np.random.default_rng([seed, int(digest[:8], 16)])
+
+def bootstrap_deltas(rng: np.random.Generator,
+                     n_exposure: int, n_slow_exposure: int,
+                     n_treatment: int, n_slow_treatment: int,
+                     n_reps: int = 10_000) -> np.ndarray:
+    """
+    The difference in the share of slow offers between the exposure and
+    treatment groups, in `n_reps` resamples of each group.
+    """
+    exposure = rng.binomial(n_exposure, n_slow_exposure / n_exposure, n_reps) / n_exposure
+    treatment = rng.binomial(n_treatment, n_slow_treatment / n_treatment, n_reps) / n_treatment
+    return exposure - treatment
+
+def permutation_deltas(rng: np.random.Generator,
+                       n_exposure: int, n_slow_exposure: int,
+                       n_treatment: int, n_slow_treatment: int,
+                       n_reps: int = 10_000) -> np.ndarray:
+    """
+    The difference in the share of slow offers between the exposure and
+    treatment groups, in `n_reps` shuffles of households between them.
+    """
+    n_slow = n_slow_exposure + n_slow_treatment
+    n_not_slow = n_exposure + n_treatment - n_slow
+    slow_exposure = rng.hypergeometric(n_slow, n_not_slow, n_exposure, n_reps)
+    return slow_exposure / n_exposure - (n_slow - slow_exposure) / n_treatment
+
+def resample(task: dict) -> dict:
+    """
+    The observed difference of one city and IV, its bootstrap confidence
+    interval, and its permutation p-value.
+    """
+    counts = task['counts']
+    n_exposure, n_slow_exposure, n_treatment, n_slow_treatment = counts
+    if n_exposure == 0 or n_treatment == 0:
+        return {}
+    delta = n_slow_exposure / n_exposure - n_slow_treatment / n_treatment
+    rng = city_rng(task['seed'], *task['key'])
+    bootstrap = bootstrap_deltas(rng, *counts, n_reps=task['n_reps'])
+    permutations = permutation_deltas(rng, *counts, n_reps=task['n_reps'])
+    low, high = np.quantile(bootstrap, [task['alpha'] / 2, 1 - task['alpha'] / 2])
+    # the same arithmetic as `delta`, so ties are exact but for rounding.
+    if task['alternative'] == 'greater':
+        extreme = permutations >= delta - 1e-12
+    else:
+        extreme = np.abs(permutations) >= abs(delta) - 1e-12
+    return {
+        'pct_pt_diff_low': low,
+        'pct_pt_diff_high': high,
+        # counting the observed difference as one of the shuffles
+        'pvalue': (extreme.sum() + 1) / (task['n_reps'] + 1),
+    }
+
+def significance(counts: pd.DataFrame,
+                 limitations: bool = False,
+                 n_reps: int = 10_000,
+                 alpha: float = .05,
+                 alternative: str = 'two-sided',
+                 seed: int = 303,
+                 n_jobs: int = 1) -> pd.DataFrame:
+    """
+    For each ISP and city in `counts` (from `disparity_counts`) and each IV,
+    the `1 - alpha` bootstrap confidence interval of its `*_pct_pt_diff`
+    (e.g. `income_pct_pt_diff_low` and `income_pct_pt_diff_high`), and its
+    permutation p-value (`income_pvalue`), from `n_reps` replicates each.
+    `alternative='greater'` only counts shuffles where the exposure group is
+    at least as much slower. Cities are spread across `n_jobs` processes,
+    and results are the same however many there are. A city and IV that
+    fails to resample is reported, and left blank.
+    Rows match `disparity_table`, to merge on `major_city`, `state` and `isp`.
+    """
+    tasks = []
+    for key, row in counts.iterrows():
+        for iv in IVS:
+            tasks.append({
+                'key': (*key, iv, limitations),
+                'counts': [int(row[(limitations, iv, group, n)])
+                           for group in ['exposure', 'treatment'] for n in ['n', 'n_slow']],
+                'n_reps': n_reps,
+                'alpha': alpha,
+                'alternative': alternative,
+                'seed': seed,
+            })
+    with Executor(n_jobs, preload=['resampling']) as executor:
+        results = list(executor.map(resample, tasks, desc='resampling'))
+
+    records = {key: {} for key in counts.index}
+    for task, result in zip(tasks, results):
+        *key, iv, _ = task['key']
+        if isinstance(result, Failure):
+            print(f"couldn't resample {', '.join(map(str, task['key']))}: {result.error}")
+            continue
+        records[tuple(key)].update({f"{iv}_{stat}": value for stat, value in result.items()})
+    cols = [f"{iv}_{stat}" for iv in IVS for stat in ['pct_pt_diff_low', 'pct_pt_diff_high', 'pvalue']]
+    table = pd.DataFrame(list(records.values()), index=counts.index).reindex(columns=cols)
+    table = table.reset_index()
+    table['major_city'] = table['major_city'].str.title()
+    return table
@@ -0,0 +1,239 @@
+"""
+Columnar storage for the speed_price_* datasets.
+
+Offers are written as a Parquet dataset partitioned by
+provider/state/major_city, so readers can load only the columns
+and cities they need.
+
+Parse workers hand their results to the parent process the same way:
+as Arrow tables, concatenated column by column, rather than pickled DataFrames.
+"""
+import os
+import json
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARTITION_COLS = ['provider', 'state', 'major_city']
+
+# Explicit types for every column we write, so nothing is left to inference.
+OFFER_SCHEMA = pa.schema([
+    ('address_full', pa.string()),
+    ('incorporated_place', pa.string()),
+    ('major_city', pa.string()),
+    ('state', pa.string()),
+    ('lat', pa.float64()),
+    ('lon', pa.float64()),
+    ('block_group', pa.string()),
+    ('collection_datetime', pa.int64()),
+    ('in_service', pa.bool_()),
+    ('provider', pa.string()),
+    ('speed_down', pa.float64()),
+    ('speed_up', pa.float64()),
+    ('speed_unit', pa.string()),
+    ('price', pa.float64()),
+    ('technology', pa.string()),
+    ('package', pa.string()),
+    ('contract_provider', pa.string()),
+    ('fastest_speed_down', pa.float64()),
+    ('fastest_speed_price', pa.float64()),
+    ('fn', pa.string()),
+    ('redlining_grade', pa.string()),
+    ('race_perc_non_white', pa.float64()),
+    ('income_lmi', pa.float64()),
+    ('ppl_per_sq_mile', pa.float64()),
+    ('n_providers', pa.float64()),
+    ('income_dollars_below_median', pa.float64()),
+    ('internet_perc_broadband', pa.float64()),
+    ('median_household_income', pa.float64()),
+])
+
+PARTITIONING = ds.partitioning(
+    pa.schema([OFFER_SCHEMA.field(c) for c in PARTITION_COLS]),
+    flavor='hive'
+)
+
+
+def offer_schema(df: pd.DataFrame) -> pa.Schema:
+    """
+    The subset of `OFFER_SCHEMA` in `df`, in `df`'s column order.
+    Columns we don't know about are stored as strings (see `to_string`).
+    """
+    fields = []
+    for col in df.columns:
+        if col in OFFER_SCHEMA.names:
+            fields.append(OFFER_SCHEMA.field(col))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def to_string(x) -> str:
+    """
+    `x` as a string for a string column: dicts and lists (e.g. Verizon's
+    `offer`) as JSON, so `json.loads` gets them back, and nulls as null.
+    """
+    if isinstance(x, (dict, list, tuple)):
+        return json.dumps(x)
+    return None if pd.isnull(x) else str(x)
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Casts `df` to an Arrow table that matches `offer_schema`.
+    """
+    df = df.copy()
+    schema = offer_schema(df)
+    for field in schema:
+        col = field.name
+        if pa.types.is_string(field.type):
+            df[col] = df[col].map(to_string)
+        elif pa.types.is_floating(field.type):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        elif pa.types.is_boolean(field.type):
+            df[col] = df[col].astype(object).where(df[col].notnull(), None)
+    for col in PARTITION_COLS:
+        # partitions can't be null, so empty values get their own directory.
+        if col in df:
+            df[col] = df[col].fillna('')
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def write_offers(df: pd.DataFrame, root: str):
+    """
+    Writes offers to a Parquet dataset under `root`, partitioned by
+    provider, state, and major_city. Existing partitions for the same
+    provider/state/city are replaced.
+    """
+    os.makedirs(root, exist_ok=True)
+    ds.write_dataset(
+        to_table(df),
+        root,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching'
+    )
+
+
+def read_offers(root: str,
+                columns: list = None,
+                isp: str = None,
+                cities: list = None,
+                states: list = None,
+                filter: ds.Expression = None) -> pd.DataFrame:
+    """
+    Reads offers from the Parquet dataset under `root`.
+    Only `columns` are read (all, by default), and the `isp`, `cities`,
+    and `states` filters are pushed down to skip whole partitions.
+    """
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    expressions = []
+    if isp:
+        expressions.append(ds.field('provider') == isp)
+    if cities:
+        expressions.append(ds.field('major_city').isin(list(cities)))
+    if states:
+        expressions.append(ds.field('state').isin(list(states)))
+    if filter is not None:
+        expressions.append(filter)
+
+    expression = None
+    for e in expressions:
+        expression = e if expression is None else expression & e
+
+    if columns is not None:
+        columns = [c for c in columns if c in dataset.schema.names]
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+def read_speed_price(fn: str,
+                     isp: str = None,
+                     columns: list = None,
+                     cities: list = None) -> pd.DataFrame:
+    """
+    Reads offers from either a speed_price_*.csv.gz file or the
+    Parquet dataset written by `write_offers`. Either way, `block_group`
+    is a 12-digit string, like the CSV writers pad it.
+    """
+    if os.path.isdir(fn):
+        return read_offers(fn, columns=columns, isp=isp, cities=cities)
+    usecols = None
+    if columns is not None:
+        usecols = lambda c: c in set(columns)
+    df = pd.read_csv(fn, usecols=usecols, dtype={'block_group': str})
+    if cities:
+        df = df[df.major_city.isin(cities)]
+    return df
+
+
+## Worker results
+# Arrow files written here live in memory, where there's a /dev/shm.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def concat_tables(tables: list) -> pd.DataFrame:
+    """
+    Concatenates Arrow tables whose columns may differ, like `pd.concat`:
+    columns are in order of first appearance, and missing ones are null.
+    The columns are joined in Arrow, and converted to pandas once.
+    """
+    tables = [t for t in tables if t.num_rows]
+    if not tables:
+        return pd.DataFrame()
+    schema = pa.unify_schemas([t.schema for t in tables])
+    aligned = []
+    for t in tables:
+        columns = [t.column(f.name) if f.name in t.column_names
+                   else pa.nulls(t.num_rows, f.type)
+                   for f in schema]
+        aligned.append(pa.Table.from_arrays(columns, schema=schema))
+    return pa.concat_tables(aligned).to_pandas()
+
+def read_parquets(fns: list) -> pd.DataFrame:
+    """
+    Reads and concatenates the Parquet files in `fns` that exist,
+    as one dataset over their combined schema.
+    """
+    fns = [fn for fn in fns if os.path.exists(fn)]
+    schemas = [pq.read_schema(fn) for fn in fns]
+    fns = [fn for fn, schema in zip(fns, schemas) if schema.names]
+    if not fns:
+        return pd.DataFrame()
+    schema = pa.unify_schemas([s for s in schemas if s.names]).remove_metadata()
+    table = ds.dataset(fns, schema=schema, format='parquet').to_table()
+    return table.to_pandas()
+
+def to_shared(df: pd.DataFrame, prefix: str = 'offers-') -> str:
+    """
+    Writes `df` as an Arrow IPC file in shared memory, and returns its path,
+    so a worker can pass the path back instead of pickling `df`.
+    """
+    fd, fn = tempfile.mkstemp(prefix=prefix, suffix='.arrow', dir=SHM_DIR)
+    os.close(fd)
+    table = to_table(df)
+    with pa.OSFile(fn, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return fn
+
+def read_shared(fns: list) -> pd.DataFrame:
+    """
+    Memory-maps the Arrow files from `to_shared`, concatenates them,
+    and deletes them.
+    """
+    tables = []
+    for fn in fns:
+        with pa.memory_map(fn) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+        os.remove(fn)
+    return concat_tables(tables)
+
+def shared_workflow(fn: str, workflow, **kwargs) -> str:
+    """
+    Runs `workflow` on `fn` and returns the path to its result from `to_shared`.
+    Use with `partial` in `Pool.imap_unordered`.
+    """
+    return to_shared(workflow(fn, **kwargs))
@@ -0,0 +1,159 @@
+"""
+Runs `census.download_acs` against a local stand-in for the Census API,
+which answers slowly and sometimes with 503s, like the real one.
+
+    cd notebooks; python -m pytest test_census.py
+"""
+import time
+import asyncio
+import threading
+import email.utils
+
+import pytest
+from aiohttp import web
+
+import census
+
+API_KEY = 'key'
+# counties whose first call gets a 503, and the one without data.
+FLAKY = {'001', '005', '007'}
+NO_DATA = '999'
+LATENCY = .02
+
+acs_tables = [
+    {
+        "display_name": "race_ethnicity",
+        "table_name": "B03002",
+        "columns": {
+            "block group": "block_group",
+            "B03002_001E": "total",
+            "B03002_003E": "white_alone_not_hispanic",
+        },
+    },
+    {
+        "display_name": "median_household_income",
+        "table_name": "B19013",
+        "columns": {
+            "block group": "block_group",
+            "B19013_001E": "median_household_income",
+        },
+    },
+]
+fips = [f"01{county:03d}" for county in range(1, 11)] + [f"01{NO_DATA}"]
+
+
+class StandIn:
+    """
+    The API's block group endpoint, counting the calls it gets.
+    """
+    def __init__(self, always_fail: set = ()):
+        self.calls = []
+        self.urls = []
+        self.always_fail = set(always_fail)
+        self.port = None
+
+    async def handle(self, request):
+        query = request.query
+        self.calls.append(query['in'])
+        self.urls.append(request.path_qs)
+        await asyncio.sleep(LATENCY)
+        if query.get('key') != API_KEY:
+            return web.Response(status=400, text='error: invalid key')
+        state, county = [part.split(':')[1] for part in query['in'].split(' ')]
+        if county in self.always_fail or (county in FLAKY and self.urls.count(request.path_qs) == 1):
+            # the API may say when to retry as seconds, or as a date.
+            when = '0' if county != '005' else email.utils.formatdate(usegmt=True)
+            return web.Response(status=503, headers={'Retry-After': when})
+        if county == NO_DATA:
+            return web.Response(status=204)
+        columns = query['get'].split(',')
+        geography = query['for'].split(':')[0]
+        rows = [columns + ['state', 'county', 'tract', geography]]
+        for tract in range(2):
+            for bg in range(1, 4):
+                rows.append([str(int(county) * 100 + i) for i, _ in enumerate(columns)]
+                            + [state, county, f"{tract:06d}", str(bg)])
+        return web.json_response(rows)
+
+    def start(self):
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get('/2019/acs/acs5', self.handle)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, 'localhost', 0)
+        loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        self.stop = lambda: asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        return self
+
+    @property
+    def base_url(self):
+        return f"http://localhost:{self.port}"
+
+
+@pytest.fixture
+def server():
+    server = StandIn().start()
+    yield server
+    server.stop()
+
+def download(server, data_dir, **kwargs):
+    return census.download_acs(fips, acs_tables, data_dir=str(data_dir), api_key=API_KEY,
+                               base_url=server.base_url, backoff=.01, **kwargs)
+
+def test_download_acs(server, tmp_path, capsys):
+    tables = download(server, tmp_path)
+    assert len(server.calls) == len(fips) + len(FLAKY)
+    assert f"{len(fips) + len(FLAKY)} requests ({len(FLAKY)} retries)" in capsys.readouterr().out
+    assert set(tables) == {'B03002', 'B19013'}
+    df = tables['B03002']
+    assert list(df.columns) == ['state', 'county', 'tract', 'block group',
+                                'B03002_001E', 'B03002_003E']
+    # 6 block groups in each county with data.
+    assert len(df) == 6 * (len(fips) - 1)
+    assert int(NO_DATA) not in set(df['county'])
+    assert (df['B03002_001E'] == df['county'] * 100).all()
+    assert (tables['B19013']['B19013_001E'] == df['county'] * 100 + 2).all()
+
+    # a warm re-run is all cache.
+    calls = len(server.calls)
+    again = download(server, tmp_path)
+    assert len(server.calls) == calls
+    assert f"{len(fips)} from the cache, 0 requests" in capsys.readouterr().out
+    for table_name, df in tables.items():
+        assert again[table_name].equals(df)
+
+    download(server, tmp_path, recalculate=True)
+    assert len(server.calls) == calls + len(fips)
+
+def test_retry_after():
+    assert census.retry_after(None) == 0
+    assert census.retry_after('2.5') == 2.5
+    assert census.retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    soon = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < census.retry_after(soon) <= 30
+    assert census.retry_after('soon') == 0
+
+def test_split_columns(server, tmp_path, monkeypatch):
+    # more columns than the API returns per call, so two calls per county.
+    monkeypatch.setattr(census, 'MAX_COLUMNS', 2)
+    tables = download(server, tmp_path)
+    assert len(server.calls) == 2 * len(fips) + 2 * len(FLAKY)
+    assert (tables['B19013']['B19013_001E'] == tables['B03002']['county'] * 100).all()
+    assert len(tables['B03002']) == 6 * (len(fips) - 1)
+
+def test_refused(server, tmp_path):
+    tables = census.download_acs(fips, acs_tables, data_dir=str(tmp_path), api_key='wrong',
+                                 base_url=server.base_url, backoff=.01)
+    # refusals aren't retried, or cached.
+    assert len(server.calls) == len(fips)
+    assert all(df.empty for df in tables.values())
+    assert not (tmp_path / 'cache').exists()
+
+def test_give_up(server, tmp_path):
+    server.always_fail = {'002'}
+    with pytest.raises(RuntimeError, match='01002: gave up after 3 attempts'):
+        download(server, tmp_path, retries=2)
+    assert server.calls.count('state:01 county:002') == 3
@@ -0,0 +1,59 @@
+"""
+Runs `manifest.parse_incremental` with a stand-in workflow that fails on
+some files, to check that the files that parsed are still collected.
+
+    cd notebooks; python -m pytest test_manifest.py
+"""
+import gzip
+import json
+
+import pandas as pd
+
+from manifest import Manifest, parse_incremental
+
+# files the stand-in workflow fails on.
+broken = set()
+
+
+def workflow(fn: str, include_plans: bool = False, stats: dict = None, sink=None):
+    """
+    Like `lookups.workflow` with a sink: one batch with a row per line of `fn`.
+    """
+    if fn in broken:
+        raise ValueError(f"can't parse {fn}")
+    with gzip.open(fn, 'rt') as f:
+        rows = [json.loads(line) for line in f]
+    sink(pd.DataFrame(rows))
+    stats.update(lines=len(rows), failures=0)
+
+def make_files(tmp_path, n: int = 4) -> list:
+    files = []
+    for i in range(n):
+        fn = tmp_path / 'isp' / 'omaha' / f"31055000{i}.geojson.gz"
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(fn, 'wt') as f:
+            for j in range(3):
+                f.write(json.dumps({'address': f"{i}-{j}", 'price': i * 10 + j}) + '\n')
+        files.append(str(fn))
+    return files
+
+def test_failed_file(tmp_path, capsys):
+    files = make_files(tmp_path)
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    broken.add(files[1])
+    try:
+        offers = parse_incremental(files, workflow, manifest, str(tmp_path / 'parsed'), n_jobs=1)
+    finally:
+        broken.clear()
+    out = capsys.readouterr().out
+    assert f"failed to parse {files[1]}" in out
+    assert "1 files failed to parse and are left out" in out
+    assert files[1] not in manifest.entries
+    assert sorted(offers.address) == [f"{i}-{j}" for i in [0, 2, 3] for j in range(3)]
+
+    # it's parsed again next time, and only it.
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    assert manifest.stale(files) == [files[1]]
+    offers = parse_incremental(files, workflow, manifest, str(tmp_path / 'parsed'), n_jobs=1)
+    assert sorted(offers.address) == [f"{i}-{j}" for i in range(4) for j in range(3)]
+    assert manifest.entries[files[1]]['stats'] == {'lines': 3, 'failures': 0}